@@ -1,12 +1,16 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse, FileResponse
-from pydantic import BaseModel, Field
-from typing import Optional, Dict
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Response
+from fastapi.responses import FileResponse
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Dict, List, Tuple
 from celery import Celery
-import shutil
+from cachetools import TTLCache
+from blake3 import blake3
+import aiofiles
+import redis.asyncio as aioredis
+import asyncio
+import io
 import os
 import uuid
-import base64
 import json
 
 
@@ -15,6 +19,8 @@ class ProcessingParams(BaseModel):
     Sprite 處理參數
     Sprite processing parameters
     """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     distance_threshold: int = Field(
         default=80,
         ge=10, le=500,
@@ -51,6 +57,8 @@ class GridParams(BaseModel):
     格線分割參數
     Grid splitting parameters
     """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     auto_detect: bool = Field(
         default=True,
         description="是否自動偵測格線 / Auto-detect grid lines"
@@ -91,6 +99,8 @@ class GenerateRequest(BaseModel):
     文字生圖請求模型
     Text-to-image generation request model
     """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     prompt: str
     model: str = "nano-banana"  # "nano-banana" or "nano-banana-pro"
     auto_process: bool = True   # 是否自動進入 Sprite 處理流程
@@ -106,26 +116,403 @@ class GenerateRequest(BaseModel):
     min_area_ratio: float = Field(default=0.0005, ge=0.0001, le=0.1)
     max_area_ratio: float = Field(default=0.25, ge=0.05, le=0.9)
     output_sizes: Optional[Dict[str, list]] = Field(default=None)
+    archive_format: str = "zip"  # "zip" or "tar.zst"
+
+
+# 檔案回應串流讀取的區塊大小 (1 MiB)
+# Chunk size used when a file response has to be streamed through Python
+FILE_CHUNK_SIZE = 1 << 20
+
+# 結果壓縮檔格式 → (media type, 副檔名)；zip 為預設，tar.zst 供支援 zstd 的用戶端選用
+# Result archive formats -> (media type, file extension); must match the worker's ARCHIVE_FORMATS
+ARCHIVE_FORMATS = {
+    "zip": ("application/zip", "zip"),
+    "tar.zst": ("application/zstd", "tar.zst"),
+}
+
+
+def validate_archive_format(archive_format: str) -> str:
+    """
+    驗證結果壓縮檔格式
+    Reject archive formats the worker cannot produce
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid archive_format. Choose from: {list(ARCHIVE_FORMATS)}"
+        )
+    return archive_format
+
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析單一 `bytes=` Range 標頭，回傳 (start, end) 含端點
+    Parse a single `bytes=start-end` Range header into an inclusive (start, end).
+
+    Returns None when the header is not a single byte range (the full file is
+    served instead). Raises HTTPException(416) when the range is unsatisfiable.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+        else:
+            # 後綴範圍：最後 N 個位元組 / Suffix range: the last N bytes
+            start = max(file_size - int(last), 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+
+    end = min(end, file_size - 1)
+    if start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, end
+
+
+class ZeroCopyFileResponse(FileResponse):
+    """
+    支援 Range 請求與 ASGI zero-copy send 的檔案回應
+    FileResponse with single-range (206 Partial Content) support that hands the
+    file descriptor to the server via the ASGI `http.response.zerocopysend`
+    extension so the kernel can sendfile(2) it. Without the extension the
+    requested slice is streamed with os.pread in a worker thread.
+    """
+
+    def __init__(self, path, *args, byte_range: Optional[Tuple[int, int]] = None, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.byte_range = byte_range
+
+    async def __call__(self, scope, receive, send):
+        if self.stat_result is None:
+            self.stat_result = await asyncio.to_thread(os.stat, self.path)
+            self.set_stat_headers(self.stat_result)
+        self.headers.setdefault("accept-ranges", "bytes")
+
+        file_size = self.stat_result.st_size
+        offset, count = 0, file_size
+        if self.byte_range is not None:
+            start, end = self.byte_range
+            offset, count = start, end - start + 1
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+            self.headers["content-length"] = str(count)
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        else:
+            extensions = scope.get("extensions") or {}
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                if "http.response.zerocopysend" in extensions:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": fd,
+                        "offset": offset,
+                        "count": count,
+                        "more_body": False,
+                    })
+                else:
+                    await self._send_slice(send, fd, offset, count)
+            finally:
+                os.close(fd)
+
+        if self.background is not None:
+            await self.background()
+
+    @staticmethod
+    async def _send_slice(send, fd: int, offset: int, count: int) -> None:
+        """以 pread 分塊送出 [offset, offset+count) / Stream a file slice with pread"""
+        remaining = count
+        while remaining > 0:
+            chunk = await asyncio.to_thread(os.pread, fd, min(FILE_CHUNK_SIZE, remaining), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            remaining -= len(chunk)
+            await send({
+                "type": "http.response.body",
+                "body": chunk,
+                "more_body": remaining > 0,
+            })
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
 
 # 初始化 FastAPI
 app = FastAPI(title="Sprite Processing Service")
 
 # 初始化 Celery 客戶端 (用來發送任務)
+# redis+poll:// 由 celery-redis-poll 透過 entry point 註冊 (以輪詢取代 pub/sub，減少 Redis 連線數)
+# redis+poll:// is registered by celery-redis-poll's entry point (polling instead of pub/sub)
+RESULT_BACKEND_URL = os.getenv("CELERY_RESULT_BACKEND", "redis+poll://redis:6379/0")
 celery_client = Celery(
     "tasks",
     broker=os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0"),
-    backend=os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/0")
+    backend=RESULT_BACKEND_URL
+)
+# 純生成任務送到 generate 佇列 (由 gevent pool 的 worker 處理，必須與 worker 的 task_routes 一致)
+# Generate-only tasks go to the generate queue served by the gevent-pool worker
+GENERATE_QUEUE = os.getenv("GENERATE_QUEUE", "generate")
+celery_client.conf.update(
+    broker_pool_limit=10,
+    broker_transport_options={"max_connections": 10, "socket_keepalive": True},
+    result_backend_transport_options={"max_connections": 10},
+    broker_connection_retry_on_startup=True,
+    task_routes={
+        "tasks.generate_image": {"queue": GENERATE_QUEUE},
+        "tasks.generate_with_reference": {"queue": GENERATE_QUEUE},
+    },
 )
 
+# 非同步 Redis 客戶端：直接讀取 Celery 結果 key，不阻塞 event loop
+# Async Redis client reading Celery result keys directly (celery-task-meta-<id>)
+result_redis = aioredis.from_url(
+    RESULT_BACKEND_URL.replace("+poll://", "://", 1),
+    max_connections=20
+)
+CELERY_META_KEY_PREFIX = "celery-task-meta-"
+
 # 共享目錄路徑
 SHARED_DIR = "/app/data"
 UPLOAD_DIR = os.path.join(SHARED_DIR, "uploads")
 RESULT_DIR = os.path.join(SHARED_DIR, "results")
 
+# 預先組好的目錄前綴，請求中直接以 f-string 串接檔名
+# Precomputed directory prefix so per-request paths skip os.path.join
+UPLOAD_PREFIX = UPLOAD_DIR + os.sep
+
+# 上傳串流寫入的區塊大小 (1 MiB)
+# Chunk size for streaming upload writes
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# /status 回應快取：終態 (SUCCESS/FAILURE) 保留 500ms，其他狀態 100ms
+# Short-lived /status response caches, collapsing duplicate result-backend GETs
+TERMINAL_STATES = ("SUCCESS", "FAILURE")
+terminal_status_cache = TTLCache(maxsize=10_000, ttl=0.5)
+pending_status_cache = TTLCache(maxsize=10_000, ttl=0.1)
+
+# 送出標記：任務在 worker 寫入狀態前一直是 PENDING，發佈前以 SET NX 記錄「已送出」避免重複執行
+# Submission markers: a queued/running task reads as PENDING, so SET NX records that it was sent
+SUBMITTED_KEY_PREFIX = "submitted:"
+SUBMITTED_MARKER_TTL = 3600
+
+# S3 直傳設定 (選用)：設定 S3_BUCKET 後啟用 presigned URL 上傳流程
+# Optional S3 direct upload: clients PUT to a presigned URL, the API never sees the bytes
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_UPLOAD_PREFIX = "uploads"
+S3_PRESIGN_EXPIRES = 3600
+s3_client = None
+if S3_BUCKET:
+    import boto3
+    s3_client = boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None)
+
 # 確保目錄存在
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(RESULT_DIR, exist_ok=True)
 
+
+def upload_file_descriptor(upload: UploadFile) -> Optional[int]:
+    """
+    取得上傳檔案底層的 OS 檔案描述子 (僅限已落地到磁碟的暫存檔)
+    Return the OS file descriptor backing an upload, or None if it is still in memory
+    """
+    spool = upload.file
+    # 記憶體中的 SpooledTemporaryFile 呼叫 fileno() 會強制寫入磁碟，因此略過
+    if not getattr(spool, "_rolled", True):
+        return None
+    try:
+        return spool.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def sendfile_copy(in_fd: int, dest_path: str) -> None:
+    """
+    以 os.sendfile 在核心內複製檔案內容 (不經過 user space)
+    Copy a whole file into dest_path with os.sendfile, page to page inside the kernel
+    """
+    size = os.fstat(in_fd).st_size
+    out_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(out_fd, in_fd, offset, min(UPLOAD_CHUNK_SIZE, size - offset))
+            if sent == 0:
+                break
+            offset += sent
+    finally:
+        os.close(out_fd)
+
+
+def hash_file_descriptor(fd: int) -> str:
+    """
+    計算檔案內容的 BLAKE3 雜湊
+    BLAKE3 hex digest of a file's contents, read with pread so the fd offset is untouched
+    """
+    hasher = blake3()
+    offset = 0
+    while chunk := os.pread(fd, UPLOAD_CHUNK_SIZE, offset):
+        hasher.update(chunk)
+        offset += len(chunk)
+    return hasher.hexdigest()
+
+
+async def save_upload_file(upload: UploadFile, dest_path: str) -> str:
+    """
+    以串流方式將上傳檔案寫入磁碟，不阻塞 event loop
+    Stream an uploaded file to disk without blocking the event loop
+
+    Uploads that were spooled to a temporary file on disk are copied with
+    os.sendfile in a worker thread; in-memory uploads are written chunk by chunk.
+
+    Returns:
+        上傳內容的 BLAKE3 雜湊 / BLAKE3 hex digest of the uploaded bytes
+    """
+    in_fd = upload_file_descriptor(upload)
+    if in_fd is not None and os.fstat(in_fd).st_size > 0:
+        try:
+            await asyncio.to_thread(sendfile_copy, in_fd, dest_path)
+            return await asyncio.to_thread(hash_file_descriptor, in_fd)
+        except OSError:
+            # 平台或檔案系統不支援 sendfile，改用一般串流寫入
+            pass
+
+    hasher = blake3()
+    await upload.seek(0)
+    async with aiofiles.open(dest_path, "wb") as buffer:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            await buffer.write(chunk)
+    return hasher.hexdigest()
+
+
+def discard_upload(path: str) -> None:
+    """
+    刪除上傳暫存檔，不存在時略過
+    Remove an uploaded file, ignoring it if it is already gone
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def save_content_addressed_upload(upload: UploadFile, task_name: str, params: dict) -> Tuple[str, str]:
+    """
+    儲存上傳檔案並以內容雜湊產生 task_id (相同圖片 + 相同參數 = 相同 task_id)
+    Save an upload under a content-derived task id.
+
+    The id hashes the image bytes together with the task name and its parameters,
+    so identical submissions map to the same Celery task and result zip.
+
+    Returns:
+        (task_id, file_path)
+    """
+    staging_path = f"{UPLOAD_PREFIX}{uuid.uuid4()}.part"
+    try:
+        content_digest = await save_upload_file(upload, staging_path)
+    except Exception:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+        raise
+
+    hasher = blake3(content_digest.encode())
+    hasher.update(task_name.encode())
+    hasher.update(json.dumps(params, sort_keys=True).encode())
+    task_id = hasher.hexdigest()[:32]
+
+    file_path = f"{UPLOAD_PREFIX}{task_id}.png"
+    os.replace(staging_path, file_path)
+    return task_id, file_path
+
+
+def in_progress_response(task_id: str) -> dict:
+    """
+    相同任務已送出時的回應
+    Submit response for an identical task that is already queued or running
+    """
+    return {
+        "task_id": task_id,
+        "status": "queued",
+        "message": "Identical task already in progress. Check status with /status/{task_id}"
+    }
+
+
+async def find_existing_task(task_id: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    查詢相同內容的任務是否已完成或正在執行
+    Look up an identical task that already succeeded or is running.
+
+    Returns (response, None) when the existing task should be reused, or
+    (None, claim_key) when the caller may resubmit via publish_once().
+    The claim key includes the previous run's date_done, so a failed or expired
+    result can be resubmitted exactly once.
+    """
+    meta = await read_task_meta(task_id)
+    status = meta["status"]
+    if status == "SUCCESS":
+        result = meta.get("result")
+        zip_path = result.get("zip_path") if isinstance(result, dict) else None
+        if zip_path and os.path.exists(zip_path):
+            return {
+                "task_id": task_id,
+                "status": "completed",
+                "download_url": f"/download/{task_id}",
+                "message": "Identical task already completed. Result reused."
+            }, None
+
+    if status in ("SUCCESS", "PENDING", "FAILURE", "REVOKED"):
+        return None, f"{SUBMITTED_KEY_PREFIX}{task_id}:{meta.get('date_done') or ''}"
+
+    return in_progress_response(task_id), None
+
+
+async def publish_once(task_id: str, claim_key: str, send) -> Optional[dict]:
+    """
+    取得送出標記後才呼叫 send() 發佈任務；送出失敗時釋放標記
+    Claim the submission marker with SET NX right before calling send().
+
+    Returns None once this request has published the task, or the in-progress
+    response when another request claimed it first. If send() raises, the
+    markers are deleted so an identical resubmit is not blocked.
+    """
+    if not await result_redis.set(claim_key, 1, nx=True, ex=SUBMITTED_MARKER_TTL):
+        return in_progress_response(task_id)
+
+    # 送出後任務在 worker 寫入狀態前都是 PENDING，由這個標記擋下重複送出
+    pending_key = f"{SUBMITTED_KEY_PREFIX}{task_id}:"
+    try:
+        if claim_key != pending_key:
+            # 舊的終態結果 (FAILURE 或 Zip 已不存在的 SUCCESS) 仍在 Redis：
+            # 先刪除，/status 與 /download 才不會在新任務執行前回報舊結果
+            async with result_redis.pipeline(transaction=True) as pipe:
+                pipe.delete(f"{CELERY_META_KEY_PREFIX}{task_id}")
+                pipe.set(pending_key, 1, ex=SUBMITTED_MARKER_TTL)
+                await pipe.execute()
+        terminal_status_cache.pop(task_id, None)
+        pending_status_cache.pop(task_id, None)
+        send()
+    except Exception:
+        await result_redis.delete(claim_key, pending_key)
+        raise
+    return None
+
+
 @app.post("/process")
 async def create_process_task(
     file: UploadFile = File(...),
@@ -134,7 +521,8 @@ async def create_process_task(
     alpha_threshold: int = Form(50),
     min_area_ratio: float = Form(0.0005),
     max_area_ratio: float = Form(0.25),
-    output_sizes_json: Optional[str] = Form(None)
+    output_sizes_json: Optional[str] = Form(None),
+    archive_format: str = Form("zip")
 ):
     """
     上傳圖片並建立處理任務
@@ -147,19 +535,115 @@ async def create_process_task(
     - **min_area_ratio**: 最小面積比例 (0.0001-0.1) / Min area ratio
     - **max_area_ratio**: 最大面積比例 (0.05-0.9) / Max area ratio
     - **output_sizes_json**: 自訂輸出尺寸 JSON 字串 / Custom output sizes JSON string (e.g. '{"icon": [64, 64]}')
+    - **archive_format**: 結果壓縮檔格式 ("zip" 或 "tar.zst") / Result archive format
     """
-    # 產生唯一 ID
-    task_id = str(uuid.uuid4())
-    filename = f"{task_id}.png"
-    file_path = os.path.join(UPLOAD_DIR, filename)
+    # 解析 output_sizes
+    output_sizes = None
+    if output_sizes_json:
+        try:
+            output_sizes = json.loads(output_sizes_json)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON format for output_sizes_json")
 
-    # 儲存上傳的檔案到共享 Volume
+    # 處理參數
+    processing_params = {
+        "distance_threshold": distance_threshold,
+        "size_ratio_threshold": size_ratio_threshold,
+        "alpha_threshold": alpha_threshold,
+        "min_area_ratio": min_area_ratio,
+        "max_area_ratio": max_area_ratio,
+        "output_sizes": output_sizes,
+        "archive_format": validate_archive_format(archive_format)
+    }
+
+    # 儲存上傳的檔案到共享 Volume，並以內容雜湊產生 ID
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        task_id, file_path = await save_content_addressed_upload(
+            file, "tasks.process_sprite", processing_params
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"File save error: {str(e)}")
 
+    # 相同內容的任務已完成或執行中則直接回傳
+    existing, claim_key = await find_existing_task(task_id)
+    if existing is not None:
+        if existing["status"] == "completed":
+            # 結果可直接重用，不會有任務讀取這份上傳
+            discard_upload(file_path)
+        return existing
+
+    # 發送任務給 Worker
+    with celery_client.producer_pool.acquire(block=True) as producer:
+        existing = await publish_once(task_id, claim_key, lambda: celery_client.send_task(
+            "tasks.process_sprite",
+            args=[file_path, task_id],
+            kwargs={"processing_params": processing_params},
+            task_id=task_id,
+            producer=producer
+        ))
+    if existing is not None:
+        return existing
+
+    return {
+        "task_id": task_id,
+        "status": "queued",
+        "message": "Task submitted successfully. Check status with /status/{task_id}"
+    }
+
+
+@app.post("/process/upload-url")
+async def create_process_upload_url():
+    """
+    取得 S3 presigned PUT URL，讓用戶端直接上傳圖片到 S3
+    Get a presigned S3 PUT URL so the client uploads the image directly to S3
+
+    After the PUT completes, call /process/commit with the returned task_id.
+    Requires the S3_BUCKET environment variable.
+    """
+    if s3_client is None:
+        raise HTTPException(status_code=501, detail="S3 direct upload is not configured")
+
+    task_id = str(uuid.uuid4())
+    upload_url = s3_client.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": S3_BUCKET, "Key": f"{S3_UPLOAD_PREFIX}/{task_id}.png"},
+        ExpiresIn=S3_PRESIGN_EXPIRES
+    )
+
+    return {
+        "task_id": task_id,
+        "upload_url": upload_url,
+        "expires_in": S3_PRESIGN_EXPIRES,
+        "message": "PUT the image to upload_url, then call /process/commit with task_id"
+    }
+
+
+@app.post("/process/commit")
+async def commit_process_task(
+    task_id: str = Form(...),
+    distance_threshold: int = Form(80),
+    size_ratio_threshold: float = Form(0.4),
+    alpha_threshold: int = Form(50),
+    min_area_ratio: float = Form(0.0005),
+    max_area_ratio: float = Form(0.25),
+    output_sizes_json: Optional[str] = Form(None),
+    archive_format: str = Form("zip")
+):
+    """
+    S3 上傳完成後建立處理任務 (Worker 直接從 S3 讀取圖片)
+    Create the processing task for an image uploaded via /process/upload-url
+
+    Accepts the same processing parameters as /process.
+    """
+    if s3_client is None:
+        raise HTTPException(status_code=501, detail="S3 direct upload is not configured")
+
+    # task_id 會成為 S3 key 的一部分，只接受 UUID
+    try:
+        task_id = str(uuid.UUID(task_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid task_id")
+
     # 解析 output_sizes
     output_sizes = None
     if output_sizes_json:
@@ -175,15 +659,19 @@ async def create_process_task(
         "alpha_threshold": alpha_threshold,
         "min_area_ratio": min_area_ratio,
         "max_area_ratio": max_area_ratio,
-        "output_sizes": output_sizes
+        "output_sizes": output_sizes,
+        "archive_format": validate_archive_format(archive_format)
     }
 
     # 發送任務給 Worker
-    task = celery_client.send_task(
-        "tasks.process_sprite",
-        args=[file_path, task_id],
-        kwargs={"processing_params": processing_params}
-    )
+    with celery_client.producer_pool.acquire(block=True) as producer:
+        task = celery_client.send_task(
+            "tasks.process_sprite",
+            args=[f"s3://{S3_BUCKET}/{S3_UPLOAD_PREFIX}/{task_id}.png", task_id],
+            kwargs={"processing_params": processing_params},
+            task_id=task_id,
+            producer=producer
+        )
 
     return {
         "task_id": task.id,
@@ -192,6 +680,82 @@ async def create_process_task(
     }
 
 
+@app.post("/process/batch")
+async def create_process_batch_task(
+    files: List[UploadFile] = File(...),
+    distance_threshold: int = Form(80),
+    size_ratio_threshold: float = Form(0.4),
+    alpha_threshold: int = Form(50),
+    min_area_ratio: float = Form(0.0005),
+    max_area_ratio: float = Form(0.25),
+    output_sizes_json: Optional[str] = Form(None),
+    archive_format: str = Form("zip")
+):
+    """
+    一次上傳多張圖片並建立處理任務 (所有圖片共用同一組參數)
+    Upload several images and create one processing task per image
+
+    All tasks are published through a single pooled producer. Accepts the same
+    processing parameters as /process.
+    """
+    # 解析 output_sizes
+    output_sizes = None
+    if output_sizes_json:
+        try:
+            output_sizes = json.loads(output_sizes_json)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON format for output_sizes_json")
+
+    # 處理參數
+    processing_params = {
+        "distance_threshold": distance_threshold,
+        "size_ratio_threshold": size_ratio_threshold,
+        "alpha_threshold": alpha_threshold,
+        "min_area_ratio": min_area_ratio,
+        "max_area_ratio": max_area_ratio,
+        "output_sizes": output_sizes,
+        "archive_format": validate_archive_format(archive_format)
+    }
+
+    # 先儲存所有上傳檔案 (此時尚未取得任何送出標記，儲存失敗不會擋住之後的重送)
+    tasks = []
+    for file in files:
+        try:
+            task_id, file_path = await save_content_addressed_upload(
+                file, "tasks.process_sprite", processing_params
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"File save error ({file.filename}): {str(e)}")
+        tasks.append((file.filename, task_id, file_path))
+
+    # 以同一個 producer 送出所有新任務，每個任務在送出前才取得標記
+    responses = {}
+    with celery_client.producer_pool.acquire(block=True) as producer:
+        for _, task_id, file_path in tasks:
+            if task_id in responses:
+                continue
+            existing, claim_key = await find_existing_task(task_id)
+            if existing is not None and existing["status"] == "completed":
+                discard_upload(file_path)
+            if existing is None:
+                existing = await publish_once(task_id, claim_key, lambda: celery_client.send_task(
+                    "tasks.process_sprite",
+                    args=[file_path, task_id],
+                    kwargs={"processing_params": processing_params},
+                    task_id=task_id,
+                    producer=producer
+                ))
+            responses[task_id] = existing
+
+    return {
+        "tasks": [
+            {"filename": filename, **(responses[task_id] or {"task_id": task_id, "status": "queued"})}
+            for filename, task_id, _ in tasks
+        ],
+        "message": "Batch submitted. Check each task with /status/{task_id}"
+    }
+
+
 @app.post("/process/grid")
 async def create_process_grid_task(
     file: UploadFile = File(...),
@@ -216,18 +780,6 @@ async def create_process_grid_task(
     - **min_line_length_ratio**: 最小線長比例 / Minimum line length ratio
     - **output_sizes_json**: 自訂輸出尺寸 JSON 字串 / Custom output sizes JSON string
     """
-    # 產生唯一 ID
-    task_id = str(uuid.uuid4())
-    filename = f"{task_id}.png"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-
-    # 儲存上傳的檔案到共享 Volume
-    try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"File save error: {str(e)}")
-
     # 解析 output_sizes
     output_sizes = None
     if output_sizes_json:
@@ -247,15 +799,36 @@ async def create_process_grid_task(
         "output_sizes": output_sizes
     }
 
+    # 儲存上傳的檔案到共享 Volume，並以內容雜湊產生 ID
+    try:
+        task_id, file_path = await save_content_addressed_upload(
+            file, "tasks.process_sprite_grid", grid_params
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"File save error: {str(e)}")
+
+    # 相同內容的任務已完成或執行中則直接回傳
+    existing, claim_key = await find_existing_task(task_id)
+    if existing is not None:
+        if existing["status"] == "completed":
+            # 結果可直接重用，不會有任務讀取這份上傳
+            discard_upload(file_path)
+        return existing
+
     # 發送任務給 Worker
-    task = celery_client.send_task(
-        "tasks.process_sprite_grid",
-        args=[file_path, task_id],
-        kwargs={"grid_params": grid_params}
-    )
+    with celery_client.producer_pool.acquire(block=True) as producer:
+        existing = await publish_once(task_id, claim_key, lambda: celery_client.send_task(
+            "tasks.process_sprite_grid",
+            args=[file_path, task_id],
+            kwargs={"grid_params": grid_params},
+            task_id=task_id,
+            producer=producer
+        ))
+    if existing is not None:
+        return existing
 
     return {
-        "task_id": task.id,
+        "task_id": task_id,
         "status": "queued",
         "message": "Grid processing task submitted. Check status with /status/{task_id}"
     }
@@ -292,7 +865,8 @@ async def create_generate_task(request: GenerateRequest):
         "alpha_threshold": request.alpha_threshold,
         "min_area_ratio": request.min_area_ratio,
         "max_area_ratio": request.max_area_ratio,
-        "output_sizes": request.output_sizes
+        "output_sizes": request.output_sizes,
+        "archive_format": validate_archive_format(request.archive_format)
     }
 
     # 選擇任務類型
@@ -302,14 +876,16 @@ async def create_generate_task(request: GenerateRequest):
         task_name = "tasks.generate_image"
 
     # 發送任務給 Worker
-    task = celery_client.send_task(
-        task_name,
-        args=[request.prompt, request.model],
-        kwargs={
-            "temperature": request.temperature,
-            "processing_params": processing_params
-        }
-    )
+    with celery_client.producer_pool.acquire(block=True) as producer:
+        task = celery_client.send_task(
+            task_name,
+            args=[request.prompt, request.model],
+            kwargs={
+                "temperature": request.temperature,
+                "processing_params": processing_params
+            },
+            producer=producer
+        )
 
     return {
         "task_id": task.id,
@@ -331,7 +907,8 @@ async def create_generate_with_reference_task(
     alpha_threshold: int = Form(50),
     min_area_ratio: float = Form(0.0005),
     max_area_ratio: float = Form(0.25),
-    output_sizes_json: Optional[str] = Form(None)
+    output_sizes_json: Optional[str] = Form(None),
+    archive_format: str = Form("zip")
 ):
     """
     使用參考圖片進行 Image-to-Image 生成
@@ -343,6 +920,7 @@ async def create_generate_with_reference_task(
     - **reference_image**: 參考圖片檔案 / Reference image file
     - **temperature**: 生成溫度 (0.0-2.0) / Generation temperature
     - **output_sizes_json**: 自訂輸出尺寸 JSON 字串
+    - **archive_format**: 結果壓縮檔格式 ("zip" 或 "tar.zst") / Result archive format
     - Processing parameters for sprite detection/merging
     """
     # 驗證 prompt 不為空
@@ -357,17 +935,6 @@ async def create_generate_with_reference_task(
             detail=f"Invalid model. Choose from: {valid_models}"
         )
 
-    # 產生唯一 ID 並儲存參考圖片
-    task_id = str(uuid.uuid4())
-    ref_filename = f"ref_{task_id}.png"
-    ref_file_path = os.path.join(UPLOAD_DIR, ref_filename)
-
-    try:
-        with open(ref_file_path, "wb") as buffer:
-            shutil.copyfileobj(reference_image.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Reference image save error: {str(e)}")
-
     # 解析 output_sizes
     output_sizes = None
     if output_sizes_json:
@@ -383,24 +950,42 @@ async def create_generate_with_reference_task(
         "alpha_threshold": alpha_threshold,
         "min_area_ratio": min_area_ratio,
         "max_area_ratio": max_area_ratio,
-        "output_sizes": output_sizes
+        "output_sizes": output_sizes,
+        "archive_format": validate_archive_format(archive_format)
     }
 
+    # 參數驗證通過後才產生唯一 ID 並儲存參考圖片，避免 400 時留下孤兒檔案
+    task_id = str(uuid.uuid4())
+    ref_filename = f"ref_{task_id}.png"
+    ref_file_path = f"{UPLOAD_PREFIX}{ref_filename}"
+
+    try:
+        await save_upload_file(reference_image, ref_file_path)
+    except Exception as e:
+        discard_upload(ref_file_path)
+        raise HTTPException(status_code=500, detail=f"Reference image save error: {str(e)}")
+
     # 選擇任務類型
     if auto_process:
         task_name = "tasks.generate_with_reference_and_process"
     else:
         task_name = "tasks.generate_with_reference"
 
-    # 發送任務給 Worker
-    task = celery_client.send_task(
-        task_name,
-        args=[ref_file_path, prompt, model],
-        kwargs={
-            "temperature": temperature,
-            "processing_params": processing_params
-        }
-    )
+    # 發送任務給 Worker；送出失敗時沒有 worker 會清理參考圖片，由這裡刪除
+    try:
+        with celery_client.producer_pool.acquire(block=True) as producer:
+            task = celery_client.send_task(
+                task_name,
+                args=[ref_file_path, prompt, model],
+                kwargs={
+                    "temperature": temperature,
+                    "processing_params": processing_params
+                },
+                producer=producer
+            )
+    except Exception:
+        discard_upload(ref_file_path)
+        raise
 
     return {
         "task_id": task.id,
@@ -410,44 +995,106 @@ async def create_generate_with_reference_task(
     }
 
 
-@app.get("/status/{task_id}")
-async def get_task_status(task_id: str):
+async def read_task_meta(task_id: str) -> dict:
     """
-    查詢任務狀態
+    從 Redis 讀取 Celery 任務結果 (JSON 序列化)
+    Read a task's Celery result metadata straight from Redis.
+
+    Unknown tasks are reported as PENDING, matching AsyncResult semantics.
+    """
+    raw = await result_redis.get(f"{CELERY_META_KEY_PREFIX}{task_id}")
+    if raw is None:
+        return {"status": "PENDING", "result": None}
+    return json.loads(raw)
+
+
+def format_task_error(result) -> str:
+    """
+    將序列化的例外轉為字串 (等同 str(exception))
+    Format a JSON-serialized Celery exception like str(exception)
     """
-    task_result = celery_client.AsyncResult(task_id)
+    if isinstance(result, dict) and "exc_message" in result:
+        exc_message = result["exc_message"]
+        if isinstance(exc_message, (list, tuple)):
+            return str(exc_message[0]) if len(exc_message) == 1 else str(tuple(exc_message))
+        return str(exc_message)
+    return str(result)
+
+
+async def fetch_task_status(task_id: str) -> dict:
+    """
+    取得任務狀態回應 (含短期快取)
+    Build the /status response body for a task, served from the TTL caches when possible
+    """
+    cached = terminal_status_cache.get(task_id) or pending_status_cache.get(task_id)
+    if cached is not None:
+        return cached
+
+    meta = await read_task_meta(task_id)
     
     response = {
         "task_id": task_id,
-        "status": task_result.status,
+        "status": meta["status"],
     }
     
-    if task_result.status == 'SUCCESS':
+    if meta["status"] == 'SUCCESS':
         response["download_url"] = f"/download/{task_id}"
-        response["result"] = task_result.result
-    elif task_result.status == 'FAILURE':
-        response["error"] = str(task_result.result)
+        response["result"] = meta["result"]
+    elif meta["status"] == 'FAILURE':
+        response["error"] = format_task_error(meta["result"])
+
+    # 快取組好的回應
+    if response["status"] in TERMINAL_STATES:
+        terminal_status_cache[task_id] = response
+    else:
+        pending_status_cache[task_id] = response
         
     return response
 
+
+@app.get("/status/{task_id}")
+async def get_task_status(task_id: str, request: Request, http_response: Response):
+    """
+    查詢任務狀態
+    回應附帶 ETag；狀態未變時以 If-None-Match 請求可得到 304 Not Modified
+    """
+    response = await fetch_task_status(task_id)
+
+    etag = f'"{task_id}:{response["status"]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    http_response.headers["ETag"] = etag
+    return response
+
 @app.get("/download/{task_id}")
-async def download_result(task_id: str):
+async def download_result(task_id: str, request: Request):
     """
     下載處理完成的 Zip 檔
+    支援 `Range: bytes=start-end` 以便用戶端平行分段下載
     """
     # 檢查 Redis 中的任務狀態
-    task_result = celery_client.AsyncResult(task_id)
-    if task_result.status != 'SUCCESS':
+    meta = await read_task_meta(task_id)
+    if meta["status"] != 'SUCCESS':
         raise HTTPException(status_code=400, detail="Task not finished or failed")
     
-    # 取得 Zip 檔案路徑
-    zip_path = task_result.result.get("zip_path")
+    # 取得 Zip (或 tar.zst) 檔案路徑
+    result = meta["result"] or {}
+    zip_path = result.get("zip_path")
+    media_type, extension = ARCHIVE_FORMATS.get(result.get("archive_format"), ARCHIVE_FORMATS["zip"])
     
     if not zip_path or not os.path.exists(zip_path):
         raise HTTPException(status_code=404, detail="Result file not found")
+
+    # 解析 Range 標頭 (單一範圍回傳 206，否則回傳完整檔案)
+    stat_result = os.stat(zip_path)
+    range_header = request.headers.get("range")
+    byte_range = parse_byte_range(range_header, stat_result.st_size) if range_header else None
         
-    return FileResponse(
-        zip_path, 
-        media_type='application/zip', 
-        filename=f"sprites_{task_id}.zip"
+    return ZeroCopyFileResponse(
+        zip_path,
+        media_type=media_type,
+        filename=f"sprites_{task_id}.{extension}",
+        stat_result=stat_result,
+        byte_range=byte_range
     )
@@ -0,0 +1,12 @@
+#!/bin/sh
+# 以 gunicorn 管理多個 uvicorn worker，讓上傳與任務提交可跨行程並行
+# Run several uvicorn workers under gunicorn so requests are served across processes.
+# WEB_CONCURRENCY 可覆寫 worker 數量 (預設 2 x CPU 核心數)
+set -e
+
+WORKERS="${WEB_CONCURRENCY:-$(( $(nproc) * 2 ))}"
+
+exec gunicorn main:app \
+    -k uvicorn.workers.UvicornWorker \
+    -w "$WORKERS" \
+    -b 0.0.0.0:8000
@@ -1,4 +1,5 @@
 import requests
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import time
 import sys
 import os
@@ -6,6 +7,10 @@ import os
 API_URL = "http://localhost:3000/api"
 IMAGE_PATH = "test_image.png"
 
+# Status polling backoff (seconds): start fast, double while unchanged (304)
+POLL_INITIAL_DELAY = 0.05
+POLL_MAX_DELAY = 2.0
+
 def test_api():
     # 1. Check API health (optional, but good practice)
     # We'll just jump to processing
@@ -17,8 +22,9 @@ def test_api():
 
     try:
         with open(IMAGE_PATH, 'rb') as f:
-            files = {'file': f}
-            response = requests.post(f"{API_URL}/process", files=files)
+            # Stream the multipart body instead of buffering it in memory
+            m = MultipartEncoder(fields={'file': (os.path.basename(IMAGE_PATH), f, 'image/png')})
+            response = requests.post(f"{API_URL}/process", data=m, headers={'Content-Type': m.content_type})
             
         if response.status_code != 200:
             print(f"Error uploading file: {response.text}")
@@ -34,13 +40,24 @@ def test_api():
 
     # 2. Poll status
     print("Polling status...")
+    etag = None
+    delay = POLL_INITIAL_DELAY
     while True:
         try:
-            status_response = requests.get(f"{API_URL}/status/{task_id}")
+            headers = {'If-None-Match': etag} if etag else {}
+            status_response = requests.get(f"{API_URL}/status/{task_id}", headers=headers)
+            if status_response.status_code == 304:
+                # Unchanged since last poll: back off
+                time.sleep(delay)
+                delay = min(delay * 2, POLL_MAX_DELAY)
+                continue
+
             if status_response.status_code != 200:
                 print(f"Error checking status: {status_response.text}")
                 break
                 
+            etag = status_response.headers.get('ETag')
+            delay = POLL_INITIAL_DELAY
             status_data = status_response.json()
             status = status_data.get("status")
             print(f"Status: {status}")
@@ -65,7 +82,7 @@ def test_api():
                 print(f"Task failed: {status_data.get('error')}")
                 break
                 
-            time.sleep(2)
+            time.sleep(delay)
             
         except Exception as e:
             print(f"Error during polling: {e}")
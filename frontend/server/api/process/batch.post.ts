@@ -0,0 +1,11 @@
+export default defineEventHandler(async (event) => {
+  const config = useRuntimeConfig()
+  const target = `${config.apiUrl}/process/batch`
+
+  // Use sendProxy to forward the request including multipart data
+  return proxyRequest(event, target, {
+    fetchOptions: {
+      method: 'POST',
+    }
+  })
+})
@@ -1,10 +1,12 @@
 import requests
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import time
 import sys
 import os
 import json
 
 API_URL = "http://localhost:3000/api"
+
 # Use a valid image path. If test_image.png doesn't exist, try to find one.
 IMAGE_PATH = "test_image.png"
 if not os.path.exists(IMAGE_PATH):
@@ -12,6 +14,10 @@ if not os.path.exists(IMAGE_PATH):
     if os.path.exists("example/generated.png"):
         IMAGE_PATH = "example/generated.png"
 
+# Status polling backoff (seconds): start fast, double while unchanged (304)
+POLL_INITIAL_DELAY = 0.05
+POLL_MAX_DELAY = 2.0
+
 def test_custom_sizes():
     print(f"Testing custom sizes with {IMAGE_PATH}...")
 
@@ -24,15 +30,16 @@ def test_custom_sizes():
         "banner": [100, 200, 100]
     }
     
-    files = {'file': open(IMAGE_PATH, 'rb')}
-    data = {
-        'output_sizes_json': json.dumps(custom_sizes),
-        'alpha_threshold': 50
-    }
-
     try:
         print(f"Uploading to {API_URL}/process with custom sizes: {custom_sizes}")
-        response = requests.post(f"{API_URL}/process", files=files, data=data)
+        with open(IMAGE_PATH, 'rb') as f:
+            # Stream the multipart body instead of buffering it in memory
+            m = MultipartEncoder(fields={
+                'file': (os.path.basename(IMAGE_PATH), f, 'image/png'),
+                'output_sizes_json': json.dumps(custom_sizes),
+                'alpha_threshold': '50'
+            })
+            response = requests.post(f"{API_URL}/process", data=m, headers={'Content-Type': m.content_type})
             
         if response.status_code != 200:
             print(f"Error uploading file: {response.text}")
@@ -48,13 +55,24 @@ def test_custom_sizes():
 
     # Poll status
     print("Polling status...")
+    etag = None
+    delay = POLL_INITIAL_DELAY
     while True:
         try:
-            status_response = requests.get(f"{API_URL}/status/{task_id}")
+            headers = {'If-None-Match': etag} if etag else {}
+            status_response = requests.get(f"{API_URL}/status/{task_id}", headers=headers)
+            if status_response.status_code == 304:
+                # Unchanged since last poll: back off
+                time.sleep(delay)
+                delay = min(delay * 2, POLL_MAX_DELAY)
+                continue
+
             if status_response.status_code != 200:
                 print(f"Error checking status: {status_response.text}")
                 break
                 
+            etag = status_response.headers.get('ETag')
+            delay = POLL_INITIAL_DELAY
             status_data = status_response.json()
             status = status_data.get("status")
             print(f"Status: {status}")
@@ -87,7 +105,7 @@ def test_custom_sizes():
                 print(f"Task failed: {status_data.get('error')}")
                 break
                 
-            time.sleep(2)
+            time.sleep(delay)
             
         except Exception as e:
             print(f"Error during polling: {e}")
@@ -3,13 +3,45 @@ Image Generator Module - 圖片生成模組
 Wrapper for Google Nano Banana Pro API (Gemini Image Generation)
 """
 
+import io
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from PIL import Image
 from google import genai
 from google.genai import types
 
 
+# 行程內共用的 API 客戶端 (重用連線池，避免每次建立新的 TLS 連線)
+# Process-wide API client so all generator instances share one connection pool
+_CLIENT: Optional[genai.Client] = None
+_CLIENT_LOCK = threading.Lock()
+
+# 多張候選圖平行解碼的執行緒上限
+# Max threads used to decode multiple returned images
+DECODE_WORKERS = 4
+
+
+def _get_client() -> genai.Client:
+    """
+    取得共用的 genai.Client (首次呼叫時建立)
+    Return the shared genai.Client, creating it on first use
+    """
+    global _CLIENT
+
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                # 支援兩種環境變數名稱
+                api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+                if not api_key:
+                    raise ValueError("GEMINI_API_KEY or GOOGLE_API_KEY environment variable not set")
+                _CLIENT = genai.Client(api_key=api_key)
+    return _CLIENT
+
+
 class NanoBananaGenerator:
     """
     封裝 Google Nano Banana Pro API
@@ -26,11 +58,7 @@ class NanoBananaGenerator:
         初始化 API 客戶端
         Initialize API client
         """
-        # 支援兩種環境變數名稱
-        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY or GOOGLE_API_KEY environment variable not set")
-        self.client = genai.Client(api_key=api_key)
+        self.client = _get_client()
 
     def generate(
         self,
@@ -73,7 +101,9 @@ class NanoBananaGenerator:
 
         print(f"[ImageGen] Response received. Type: {type(response)}")
 
-        images = []
+        # 先收集原始位元組，切片後才解碼，多餘的候選圖不需付出解碼成本
+        # Collect raw bytes first; only the images actually returned get decoded
+        image_payloads = []
 
         # 嘗試從 response.parts 取得圖片
         if hasattr(response, 'parts') and response.parts:
@@ -83,12 +113,12 @@ class NanoBananaGenerator:
                 has_data = hasattr(part, 'inline_data') and part.inline_data is not None
                 print(f"[ImageGen]   Part {i}: text={has_text}, inline_data={has_data}")
                 if has_data:
-                    images.append(part.as_image())
+                    image_payloads.append(part.inline_data.data)
         else:
             print(f"[ImageGen] No parts in response.parts")
 
         # 備用：從 candidates 取得圖片
-        if not images and hasattr(response, 'candidates') and response.candidates:
+        if not image_payloads and hasattr(response, 'candidates') and response.candidates:
             print(f"[ImageGen] Checking candidates ({len(response.candidates)} found)")
             for ci, candidate in enumerate(response.candidates):
                 print(f"[ImageGen]   Candidate {ci}: finish_reason={candidate.finish_reason}")
@@ -98,13 +128,13 @@ class NanoBananaGenerator:
                         has_data = hasattr(part, 'inline_data') and part.inline_data is not None
                         print(f"[ImageGen]     Part {pi}: inline_data={has_data}")
                         if has_data:
-                            images.append(part.as_image())
+                            image_payloads.append(part.inline_data.data)
                 else:
                     print(f"[ImageGen]   Candidate {ci}: no content or parts")
 
-        print(f"[ImageGen] Total images extracted: {len(images)}")
+        print(f"[ImageGen] Total images extracted: {len(image_payloads)}")
 
-        if not images:
+        if not image_payloads:
             # 提供更詳細的錯誤訊息
             error_msg = "No image generated from API."
             if hasattr(response, 'candidates') and response.candidates:
@@ -117,7 +147,14 @@ class NanoBananaGenerator:
                             error_msg += f" Response text: {part.text[:200]}"
             raise ValueError(error_msg)
 
-        return images[:number_of_images]
+        selected = image_payloads[:number_of_images]
+        if len(selected) == 1:
+            return [self._decode_image(selected[0])]
+
+        # 多張圖片時以執行緒平行解碼 (PNG 解碼在 C 層釋放 GIL)
+        # Decode several images in parallel; libpng inflate releases the GIL
+        with ThreadPoolExecutor(max_workers=min(DECODE_WORKERS, len(selected))) as executor:
+            return list(executor.map(self._load_image, selected))
 
     def edit(
         self,
@@ -156,6 +193,24 @@ class NanoBananaGenerator:
 
         raise ValueError("No image generated from edit")
 
+    @staticmethod
+    def _decode_image(data: bytes) -> Image.Image:
+        """
+        將 API 回傳的圖片位元組包裝成 PIL Image (延遲解碼，實際像素於使用時才載入)
+        Wrap raw image bytes as a lazily-decoded PIL Image
+        """
+        return Image.open(io.BytesIO(data))
+
+    @classmethod
+    def _load_image(cls, data: bytes) -> Image.Image:
+        """
+        立即解碼圖片像素
+        Decode image bytes eagerly (used by the parallel decode path)
+        """
+        image = cls._decode_image(data)
+        image.load()
+        return image
+
     def _optimize_prompt_for_sprite(self, prompt: str) -> str:
         """
         優化 prompt 以生成適合 Sprite 處理的圖片
@@ -167,22 +222,22 @@ class NanoBananaGenerator:
         Returns:
             優化後的 prompt / Optimized prompt
         """
-        # 檢查是否已包含關鍵字
-        # Check if prompt already contains key terms
-        prompt_lower = prompt.lower()
+        # 檢查是否已包含關鍵字 (單次切詞後以集合查詢)
+        # Check if prompt already contains key terms (tokenize once, O(1) lookups)
+        tokens = set(re.findall(r"[a-z]+", prompt.lower()))
 
         additions = []
 
         # 建議加入透明背景
-        if "transparent" not in prompt_lower and "background" not in prompt_lower:
+        if not tokens & {"transparent", "background"}:
             additions.append("with transparent or solid color background")
 
         # 建議加入清晰邊緣
-        if "sprite" not in prompt_lower and "game" not in prompt_lower:
+        if not tokens & {"sprite", "game"}:
             additions.append("game sprite style")
 
         # 建議清晰分離
-        if "isolated" not in prompt_lower and "separate" not in prompt_lower:
+        if not tokens & {"isolated", "separate"}:
             additions.append("clearly isolated elements")
 
         if additions:
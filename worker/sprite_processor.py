@@ -12,6 +12,8 @@ Sprite Processor - 一站式 Sprite 處理工具
 import os
 import sys
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 # 加入這行來啟用 MPS 回退機制
@@ -19,9 +21,12 @@ os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
 import cv2
 import torch
+import torch.nn.functional as F
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from PIL import Image
-from torchvision import transforms
 from transformers import AutoModelForImageSegmentation
 
 
@@ -43,6 +48,15 @@ class IntegratedSpriteProcessor:
         'small': (96, 74)
     }
 
+    # 偵測視覺化 JPEG 品質（僅供檢視，80 約可減少 3 倍檔案大小）
+    VIS_JPEG_QUALITY = 80
+
+    # PNG 壓縮等級（仍為無損；1 的編碼速度比預設 6 快數倍，檔案僅略大）
+    PNG_COMPRESS_LEVEL = 1
+
+    # 格線偵測允許的線段斷點長度（等同原本 HoughLinesP 的 maxLineGap）
+    GRID_MAX_LINE_GAP = 50
+
     def __init__(self):
         """初始化處理器"""
         # 設定裝置
@@ -52,10 +66,17 @@ class IntegratedSpriteProcessor:
         elif torch.cuda.is_available():
             self.device = 'cuda'
             print("✓ 檢測到 NVIDIA GPU，啟用 CUDA 加速")
+            # 輸入固定為 1024x1024：讓 cuDNN 只挑選一次最快的卷積演算法，並啟用 TF32 matmul
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
         else:
             self.device = 'cpu'
             print("⚠ 使用 CPU 模式（較慢）")
 
+        # CUDA 輸入像素用的 pinned host 緩衝區（首次推論時配置）與專用複製 stream
+        self._pinned_input = None
+        self._copy_stream = torch.cuda.Stream() if self.device == 'cuda' else None
+
         self._init_birefnet()
 
     def _init_birefnet(self):
@@ -67,75 +88,207 @@ class IntegratedSpriteProcessor:
                 'ZhengPeng7/BiRefNet',
                 trust_remote_code=True
             )
-            self.birefnet.to(self.device)
+            # GPU (CUDA/MPS) 以 FP16 權重推論：頻寬減半、啟用 tensor core
+            # CPU 維持 FP32（多數 CPU 缺少快速的半精度運算）
+            self.model_dtype = torch.float16 if self.device in ('cuda', 'mps') else torch.float32
+            self.birefnet.to(self.device, dtype=self.model_dtype)
+            if self.device == 'cuda':
+                # NHWC 記憶體排列讓 cuDNN 的 FP16 卷積可直接走 tensor core
+                self.birefnet.to(memory_format=torch.channels_last)
             self.birefnet.eval()
+            self.birefnet.requires_grad_(False)
             print("✓ BiRefNet 載入成功")
         except Exception as e:
             print(f"✗ BiRefNet 載入失敗: {e}")
             raise
 
-        self.transform_biref = transforms.Compose([
-            transforms.Resize((1024, 1024)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+        self._compile_birefnet()
+
+        # ImageNet 正規化參數，直接放在裝置上供 tensor 前處理使用
+        self.norm_mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self.norm_std = torch.tensor([0.229, 0.224, 0.225], device=self.device).view(1, 3, 1, 1)
+
+    def _compile_birefnet(self):
+        """
+        CUDA 上以 torch.compile 針對固定 1024x1024 輸入編譯模型並預熱
+        Compile BiRefNet for the fixed input shape on CUDA; keep eager mode elsewhere
+        """
+        if self.device != 'cuda':
+            return
+
+        eager_model = self.birefnet
+        try:
+            print("正在編譯 BiRefNet (torch.compile)...")
+            self.birefnet = torch.compile(eager_model, mode='reduce-overhead', dynamic=False)
+            # 預熱：第一次呼叫會觸發編譯，避免落在第一個任務上
+            dummy = torch.zeros((1, 3, 1024, 1024), device=self.device, dtype=self.model_dtype)
+            dummy = dummy.contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode():
+                self.birefnet(dummy)
+            torch.cuda.synchronize()
+            print("✓ BiRefNet 編譯完成")
+        except Exception as e:
+            print(f"⚠ torch.compile 失敗，改用 eager 模式: {e}")
+            self.birefnet = eager_model
+
+    def _inference_batch_size(self):
+        """依裝置與可用記憶體決定 BiRefNet 批次大小"""
+        if self.device == 'cuda':
+            # 1024x1024 輸入每張約需 1.5GB 顯存（含中間特徵）
+            free_bytes, _ = torch.cuda.mem_get_info()
+            return max(1, min(16, int(free_bytes // (1536 * 1024 * 1024))))
+        if self.device == 'mps':
+            return 4
+        return 1
+
+    def _pinned_input_buffer(self, num_bytes):
+        """取得至少 num_bytes 的 pinned uint8 host 緩衝區（不足時才重新配置）"""
+        buffer = self._pinned_input
+        if buffer is None or buffer.numel() < num_bytes:
+            buffer = torch.empty(num_bytes, dtype=torch.uint8, pin_memory=True)
+            self._pinned_input = buffer
+        return buffer
+
+    def _preprocess_batch(self, images):
+        """
+        BiRefNet 前處理：只上傳 uint8 像素，resize 與 normalize 在裝置上完成
+        Upload raw pixels once; resize + normalize run as tensor ops on the device
+        """
+        if self.device == 'cuda':
+            # 整批像素放進同一塊 pinned 緩衝區，並在專用 stream 上逐張上傳，
+            # 讓下一張的 H2D 複製與前一張的 resize 重疊執行
+            arrays = [np.asarray(image) for image in images]
+            host = self._pinned_input_buffer(sum(a.size for a in arrays))
+            uploads = []
+            offset = 0
+            for a in arrays:
+                chunk = host[offset:offset + a.size].view(a.shape)
+                chunk.numpy()[...] = a
+                with torch.cuda.stream(self._copy_stream):
+                    pixels = chunk.to(self.device, non_blocking=True)
+                    ready = torch.cuda.Event()
+                    ready.record()
+                uploads.append((pixels, ready))
+                offset += a.size
+        else:
+            uploads = [(torch.from_numpy(np.array(image)).to(self.device), None) for image in images]
+
+        resized = []
+        for pixels, ready in uploads:
+            if ready is not None:
+                # 等待該張複製完成；並告知 allocator 此 tensor 也在運算 stream 上使用
+                torch.cuda.current_stream().wait_event(ready)
+                pixels.record_stream(torch.cuda.current_stream())
+            x = pixels.permute(2, 0, 1).unsqueeze(0).float().div_(255)
+            resized.append(F.interpolate(x, size=(1024, 1024), mode='bilinear',
+                                         align_corners=False, antialias=True))
+        # 正規化以 in-place 運算完成，不額外配置整批 1024² 的暫存 tensor
+        batch = torch.cat(resized).sub_(self.norm_mean).div_(self.norm_std)
+        if self.device == 'cuda':
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch.to(self.model_dtype)
+
+    def _predict_masks(self, images):
+        """對一批 RGB 圖片執行單次 BiRefNet 推論，回傳各自原尺寸的 uint8 alpha 陣列"""
+        batch = self._preprocess_batch(images)
+
+        masks = []
+        with torch.inference_mode():
+            # sigmoid 與後續 resize 保持 FP32 以維持遮罩品質
+            preds = self.birefnet(batch)[-1].float().sigmoid()
+
+            # 1024² → 原尺寸的縮放直接在裝置上完成，只把最終 uint8 遮罩搬回 CPU
+            for image, pred in zip(images, preds):
+                width, height = image.size
+                # bicubic 品質接近原本的 LANCZOS；antialias 處理原圖小於 1024 的縮小情況
+                mask = F.interpolate(pred.unsqueeze(0), size=(height, width),
+                                     mode='bicubic', align_corners=False, antialias=True)
+                # bicubic 會產生超出 [0, 1] 的過衝，先 clamp 再轉 uint8
+                mask = mask.clamp_(0, 1).mul_(255).to(torch.uint8)
+                masks.append(mask[0, 0].cpu().numpy())
+        return masks
+
+    @staticmethod
+    def _open_rgb(image):
+        """
+        接受圖片路徑、PIL Image 或 RGB/RGBA ndarray，回傳 RGB 的 PIL Image
+        In-memory inputs skip the file open/decode entirely
+        """
+        if isinstance(image, Image.Image):
+            return image if image.mode == "RGB" else image.convert("RGB")
+        if isinstance(image, np.ndarray):
+            return Image.fromarray(image).convert("RGB")
+        return Image.open(image).convert("RGB")
 
     def remove_background(self, image_path):
-        """步驟 1: 去背景"""
+        """步驟 1: 去背景（image_path 也可以是 PIL Image 或 RGB ndarray）"""
         print("\n[步驟 1/4] 執行 BiRefNet 去背景...")
-        image = Image.open(image_path).convert("RGB")
-        original_size = image.size
+        image = self._open_rgb(image_path)
 
-        input_tensor = self.transform_biref(image).unsqueeze(0).to(self.device)
+        alpha = self._predict_masks([image])[0]
 
-        with torch.no_grad():
-            preds = self.birefnet(input_tensor)[-1].sigmoid().cpu()
+        clean_image = self._attach_alpha(image, alpha)
+        print("✓ 去背景完成")
+        return clean_image, alpha
 
-        pred_mask = preds.squeeze()
-        mask_pil = transforms.ToPILImage()(pred_mask)
-        mask_pil = mask_pil.resize(original_size, Image.Resampling.LANCZOS)
+    def remove_background_batch(self, image_paths):
+        """
+        批次去背景：多張圖片共用一次 forward pass
+        Batched background removal (one BiRefNet forward per batch)
 
-        image.putalpha(mask_pil)
-        print("✓ 去背景完成")
-        return image, np.array(mask_pil)
+        Returns:
+            list of (clean_image, alpha_channel)，順序與 image_paths 相同
+        """
+        print(f"\n[批次去背] 一次推論 {len(image_paths)} 張圖片...")
+        images = [self._open_rgb(p) for p in image_paths]
+        masks = self._predict_masks(images)
+
+        return [(self._attach_alpha(image, alpha), alpha) for image, alpha in zip(images, masks)]
+
+    @staticmethod
+    def _attach_alpha(image, alpha):
+        """以 NumPy 直接組出 RGBA，避免 putalpha 的模式轉換複本"""
+        rgba = np.dstack([np.asarray(image), alpha])
+        return Image.fromarray(rgba, 'RGBA')
 
     def detect_bboxes_opencv(self, alpha_channel, min_area_ratio=0.0005, max_area_ratio=0.25, alpha_threshold=50):
         """步驟 2: 偵測連通區域"""
         print("\n[步驟 2/4] 使用 OpenCV 偵測連通區域...")
 
-        _, binary = cv2.threshold(alpha_channel, alpha_threshold, 255, cv2.THRESH_BINARY)
+        # OpenCV 需要 C-contiguous uint8；預先轉好，避免各個 cv2 呼叫內部各自複製
+        alpha_channel = np.ascontiguousarray(alpha_channel, dtype=np.uint8)
+        binary = np.empty_like(alpha_channel)
+        cv2.threshold(alpha_channel, alpha_threshold, 255, cv2.THRESH_BINARY, dst=binary)
 
+        # 閉運算補回 1~2px 的縫隙與孔洞，乾淨遮罩上的硬縫隙同樣需要，因此一律執行（原地運算）
         kernel_small = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-        binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel_small, iterations=1)
+        cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel_small, dst=binary, iterations=1)
 
-        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        # 明確指定 BBDT 標記演算法（8-連通）
+        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            binary, 8, cv2.CV_32S, cv2.CCL_BBDT)
 
         h, w = alpha_channel.shape
         min_area = w * h * min_area_ratio
         max_area = w * h * max_area_ratio
 
-        bboxes = []
-        for i in range(1, num_labels):
-            area = stats[i, cv2.CC_STAT_AREA]
+        # 以 NumPy 一次過濾所有連通區域（跳過背景 label 0）
+        # Vectorized area / aspect-ratio filter over the stats table
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        widths = stats[1:, cv2.CC_STAT_WIDTH]
+        heights = stats[1:, cv2.CC_STAT_HEIGHT]
+        aspect_ratios = np.where(heights > 0, widths / np.maximum(heights, 1), 0)
 
-            if min_area < area < max_area:
-                x = stats[i, cv2.CC_STAT_LEFT]
-                y = stats[i, cv2.CC_STAT_TOP]
-                bw = stats[i, cv2.CC_STAT_WIDTH]
-                bh = stats[i, cv2.CC_STAT_HEIGHT]
+        keep = (areas > min_area) & (areas < max_area) & (aspect_ratios > 0.05) & (aspect_ratios < 20.0)
+        keep = np.nonzero(keep)[0] + 1
 
-                aspect_ratio = float(bw) / bh if bh > 0 else 0
-
-                if 0.05 < aspect_ratio < 20.0:
-                    mask = (labels == i).astype(np.uint8) * 255
-                    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-                    bboxes.append({
-                        'bbox': [x, y, bw, bh],
-                        'area': area,
-                        'contour': contours[0] if contours else None,
-                        'centroid': centroids[i]
-                    })
+        # 下游只使用 bbox，不再逐一以 labels == i 掃描整張圖求輪廓
+        bboxes = [{
+            'bbox': [x, y, bw, bh],
+            'area': area,
+            'contour': None,
+            'centroid': centroid
+        } for (x, y, bw, bh, area), centroid in zip(stats[keep], centroids[keep])]
 
         print(f"✓ 偵測到 {len(bboxes)} 個區域")
         return bboxes
@@ -147,97 +300,64 @@ class IntegratedSpriteProcessor:
         if not bboxes:
             return []
 
-        areas = sorted([b['area'] for b in bboxes])
-        median_area = areas[len(areas) // 2]
+        # 以位置索引區分大小區域，不再另建 large/small 清單
+        n = len(bboxes)
+        area_arr = np.array([b['area'] for b in bboxes])
+        # introselect O(N) 取中位數，不需完整排序
+        median_area = np.partition(area_arr, n // 2)[n // 2]
         threshold_area = median_area * size_ratio_threshold
 
-        large_boxes = [b for b in bboxes if b['area'] >= threshold_area]
-        small_boxes = [b for b in bboxes if b['area'] < threshold_area]
-
-        print(f"  大型區域: {len(large_boxes)}, 小型區域: {len(small_boxes)}")
+        is_large = area_arr >= threshold_area
+        large_idx = np.flatnonzero(is_large)
+        small_idx = np.flatnonzero(~is_large)
+
+        print(f"  大型區域: {len(large_idx)}, 小型區域: {len(small_idx)}")
+
+        # 以 cKDTree 一次找出所有距離在門檻內的中心點配對（O(N log N)）
+        # Spatial index over all bbox centers instead of all-pairs loops
+        xywh = np.array([b['bbox'] for b in bboxes], dtype=np.int64)
+        centers = xywh[:, :2] + xywh[:, 2:] // 2
+
+        pairs = cKDTree(centers).query_pairs(distance_threshold, output_type='ndarray')
+        if len(pairs):
+            # query_pairs 含邊界 (<=)，再以平方距離還原原本的嚴格小於 (<)
+            d2 = ((centers[pairs[:, 0]] - centers[pairs[:, 1]]) ** 2).sum(-1)
+            # 只合併 大-小 與 大-大 配對；小型區域之間不直接合併
+            keep = (d2 < distance_threshold ** 2) & (is_large[pairs[:, 0]] | is_large[pairs[:, 1]])
+            pairs = pairs[keep]
+
+        # 以連通元件（取代 Python 並查集）決定哪些區域應該合併在一起
+        # Connected components over the kept pairs, computed in C by scipy
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                           shape=(n, n))
+        _, group_ids = connected_components(graph, directed=False)
+
+        # 依群組編號排序後以 reduceat 一次求出每個群組的外框
+        # Group bounds via min/max reduceat over group-sorted bbox rows
+        order = np.argsort(group_ids, kind='stable')
+        sorted_ids = group_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        counts = np.diff(np.r_[starts, n])
+
+        x0, y0 = xywh[order, 0], xywh[order, 1]
+        x1, y1 = x0 + xywh[order, 2], y0 + xywh[order, 3]
+        merged_x = np.minimum.reduceat(x0, starts)
+        merged_y = np.minimum.reduceat(y0, starts)
+        merged_w = np.maximum.reduceat(x1, starts) - merged_x
+        merged_h = np.maximum.reduceat(y1, starts) - merged_y
+
+        # 維持群組依第一個成員出現順序輸出
+        group_order = np.argsort(order[starts], kind='stable')
 
-        # 使用並查集（Union-Find）來追蹤哪些區域應該合併在一起
-        n = len(bboxes)
-        parent = list(range(n))
-
-        def find(x):
-            if parent[x] != x:
-                parent[x] = find(parent[x])
-            return parent[x]
-
-        def union(x, y):
-            px, py = find(x), find(y)
-            if px != py:
-                parent[px] = py
-
-        # 為每個 bbox 建立索引對照
-        bbox_to_idx = {id(b): i for i, b in enumerate(bboxes)}
-
-        # 1. 先合併大型區域與附近的小型區域
-        for large_box in large_boxes:
-            lx, ly, lw, lh = large_box['bbox']
-            lx_center = lx + lw // 2
-            ly_center = ly + lh // 2
-            large_idx = bbox_to_idx[id(large_box)]
-
-            for small_box in small_boxes:
-                sx, sy, sw, sh = small_box['bbox']
-                sx_center = sx + sw // 2
-                sy_center = sy + sh // 2
-
-                distance = np.sqrt((lx_center - sx_center)**2 + (ly_center - sy_center)**2)
-
-                if distance < distance_threshold:
-                    small_idx = bbox_to_idx[id(small_box)]
-                    union(large_idx, small_idx)
-
-        # 2. 合併距離夠近的大型區域（解決文字+人物分離的問題）
-        for i, box1 in enumerate(large_boxes):
-            x1, y1, w1, h1 = box1['bbox']
-            cx1, cy1 = x1 + w1 // 2, y1 + h1 // 2
-
-            for box2 in large_boxes[i+1:]:
-                x2, y2, w2, h2 = box2['bbox']
-                cx2, cy2 = x2 + w2 // 2, y2 + h2 // 2
-
-                distance = np.sqrt((cx1 - cx2)**2 + (cy1 - cy2)**2)
-
-                if distance < distance_threshold:
-                    idx1 = bbox_to_idx[id(box1)]
-                    idx2 = bbox_to_idx[id(box2)]
-                    union(idx1, idx2)
-
-        # 將同一群組的 boxes 收集在一起
-        groups = {}
-        for i, bbox in enumerate(bboxes):
-            root = find(i)
-            if root not in groups:
-                groups[root] = []
-            groups[root].append(bbox)
-
-        # 合併每個群組
         merged_boxes = []
-        for group_boxes in groups.values():
-            all_x = []
-            all_y = []
-            all_contours = []
-
-            for box in group_boxes:
-                x, y, w, h = box['bbox']
-                all_x.extend([x, x + w])
-                all_y.extend([y, y + h])
-                all_contours.append(box['contour'])
-
-            merged_x = min(all_x)
-            merged_y = min(all_y)
-            merged_w = max(all_x) - merged_x
-            merged_h = max(all_y) - merged_y
-
+        for g in group_order:
+            members = order[starts[g]:starts[g] + counts[g]]
+            x, y, w, h = int(merged_x[g]), int(merged_y[g]), int(merged_w[g]), int(merged_h[g])
             merged_boxes.append({
-                'bbox': [merged_x, merged_y, merged_w, merged_h],
-                'area': merged_w * merged_h,
-                'merged_from': len(group_boxes),
-                'contours': all_contours
+                'bbox': [x, y, w, h],
+                'area': w * h,
+                'merged_from': int(counts[g]),
+                'contours': [bboxes[i]['contour'] for i in members]
             })
 
         print(f"✓ 合併後剩餘 {len(merged_boxes)} 個 sprites（從 {len(bboxes)} 個區域合併）")
@@ -245,10 +365,11 @@ class IntegratedSpriteProcessor:
 
     def split_sprites(self, image_path, output_dir, distance_threshold=80,
                      size_ratio_threshold=0.4, padding=5, alpha_threshold=50,
-                     min_area_ratio=0.0005, max_area_ratio=0.25):
-        """執行分割流程"""
+                     min_area_ratio=0.0005, max_area_ratio=0.25, background=None):
+        """執行分割流程（background 可傳入已去背的 (image, alpha) 以略過步驟 1）"""
+        source = image_path if isinstance(image_path, (str, Path)) else "記憶體中的圖片"
         print(f"\n{'='*60}")
-        print(f"開始處理: {image_path}")
+        print(f"開始處理: {source}")
         print(f"{'='*60}")
 
         # 建立輸出目錄結構
@@ -256,12 +377,14 @@ class IntegratedSpriteProcessor:
         original_dir = base_dir / "original_sprites"
         original_dir.mkdir(parents=True, exist_ok=True)
 
-        # 1. 去背景
-        clean_image, alpha_channel = self.remove_background(image_path)
+        # 1. 去背景（批次模式下已預先算好）
+        if background is None:
+            background = self.remove_background(image_path)
+        clean_image, alpha_channel = background
 
         # 儲存去背結果
         debug_path = base_dir / "debug_background_removal.png"
-        clean_image.save(debug_path)
+        clean_image.save(debug_path, compress_level=self.PNG_COMPRESS_LEVEL)
         print(f"  已儲存去背圖: {debug_path}")
 
         # 2. 偵測 bboxes
@@ -276,44 +399,57 @@ class IntegratedSpriteProcessor:
 
         # 4. 提取並儲存 sprites
         print(f"\n[步驟 4/4] 提取並儲存 sprites...")
-        base_name = Path(image_path).stem
 
         # 視覺化
-        img_bgr = cv2.cvtColor(np.array(clean_image.convert("RGB")), cv2.COLOR_RGB2BGR)
-        vis = img_bgr.copy()
+        # 直接由 RGBA 陣列轉 BGR（cvtColor 已產生新陣列，不需再 copy）
+        rgba = np.asarray(clean_image)
+        vis = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+        img_h, img_w = rgba.shape[:2]
+
+        def save_crop(crop, save_path):
+            # 中間產物以低壓縮等級寫出，編碼時間遠低於預設等級
+            Image.fromarray(crop, 'RGBA').save(save_path, optimize=False,
+                                               compress_level=self.PNG_COMPRESS_LEVEL)
 
         sprite_paths = []
-        for i, box_data in enumerate(merged_boxes):
-            x, y, w, h = box_data['bbox']
+        # libpng 編碼時會釋放 GIL，以執行緒池並行儲存
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            saves = []
+            for i, box_data in enumerate(merged_boxes):
+                x, y, w, h = box_data['bbox']
 
-            # 添加 padding
-            x_start = max(0, x - padding)
-            y_start = max(0, y - padding)
-            x_end = min(clean_image.width, x + w + padding)
-            y_end = min(clean_image.height, y + h + padding)
+                # 添加 padding
+                x_start = max(0, x - padding)
+                y_start = max(0, y - padding)
+                x_end = min(img_w, x + w + padding)
+                y_end = min(img_h, y + h + padding)
 
-            # 裁切 sprite
-            sprite_crop = clean_image.crop((x_start, y_start, x_end, y_end))
+                # 裁切 sprite（NumPy 切片，不複製）
+                sprite_crop = rgba[y_start:y_end, x_start:x_end]
 
-            # 儲存
-            filename = f"sprite_{i:03d}.png"
-            save_path = original_dir / filename
-            sprite_crop.save(save_path)
-            sprite_paths.append(save_path)
+                # 儲存
+                filename = f"sprite_{i:03d}.png"
+                save_path = original_dir / filename
+                saves.append(pool.submit(save_crop, sprite_crop, save_path))
+                sprite_paths.append(save_path)
 
-            # 視覺化
-            color = (0, 255, 0) if box_data.get('merged_from', 1) > 1 else (255, 0, 0)
-            cv2.rectangle(vis, (x, y), (x + w, y + h), color, 2)
+                # 視覺化
+                color = (0, 255, 0) if box_data.get('merged_from', 1) > 1 else (255, 0, 0)
+                cv2.rectangle(vis, (x, y), (x + w, y + h), color, 2)
 
-            if box_data.get('merged_from', 1) > 1:
-                cv2.putText(vis, f"M{box_data['merged_from']}", (x, y - 5),
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+                if box_data.get('merged_from', 1) > 1:
+                    cv2.putText(vis, f"M{box_data['merged_from']}", (x, y - 5),
+                               cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
 
-            print(f"  ✓ {filename} ({w}×{h})")
+                print(f"  ✓ {filename} ({w}×{h})")
+
+            # 等待所有儲存完成，並讓寫檔錯誤照常拋出
+            for future in saves:
+                future.result()
 
         # 儲存視覺化
         vis_path = base_dir / "detection_visualization.jpg"
-        cv2.imwrite(str(vis_path), vis)
+        cv2.imwrite(str(vis_path), vis, [cv2.IMWRITE_JPEG_QUALITY, self.VIS_JPEG_QUALITY])
         print(f"\n✓ 分割完成，共 {len(merged_boxes)} 個 sprites")
         print(f"  視覺化: {vis_path}")
 
@@ -334,30 +470,55 @@ class IntegratedSpriteProcessor:
             print("找不到 sprite 檔案")
             return
 
+        # 先建立所有輸出目錄
+        output_dirs = {}
         for size_name, (canvas_w, canvas_h) in size_configs.items():
             print(f"\n處理尺寸: {size_name} (canvas={canvas_w}×{canvas_h}, fit-within-bounds)")
-
             output_dir = Path(output_base_dir) / size_name
             output_dir.mkdir(parents=True, exist_ok=True)
+            output_dirs[size_name] = output_dir
 
-            for sprite_file in sprite_files:
-                try:
-                    image = Image.open(sprite_file)
+        def load_one(sprite_file):
+            # 每個 sprite 只解碼一次，供所有尺寸共用
+            try:
+                image = Image.open(sprite_file)
+
+                if image.mode != 'RGBA':
+                    image = image.convert('RGBA')
+                image.load()
+                return image, None
+            except Exception as e:
+                return None, f"  ✗ 處理 {sprite_file.name} 失敗: {e}"
 
-                    if image.mode != 'RGBA':
-                        image = image.convert('RGBA')
+        def resize_one(job):
+            sprite_file, image, size_name, canvas_w, canvas_h = job
+            try:
+                # 調整大小並置中
+                processed = self._resize_and_center(image, canvas_w, canvas_h)
 
-                    # 調整大小並置中
-                    processed = self._resize_and_center(image, canvas_w, canvas_h)
+                output_path = output_dirs[size_name] / sprite_file.name
+                processed.save(output_path, 'PNG', compress_level=self.PNG_COMPRESS_LEVEL)
 
-                    output_path = output_dir / sprite_file.name
-                    processed.save(output_path, 'PNG')
+                return f"  ✓ {size_name}/{sprite_file.name}"
 
-                    print(f"  ✓ {sprite_file.name}")
+            except Exception as e:
+                return f"  ✗ 處理 {size_name}/{sprite_file.name} 失敗: {e}"
+
+        # PIL 的 resize / PNG 編碼會釋放 GIL，以執行緒池並行處理
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            # 先解碼，再把 (sprite, 尺寸) 攤平成獨立工作：sprite 少、尺寸多時也能用滿所有核心
+            jobs = []
+            for sprite_file, (image, error) in zip(sprite_files, pool.map(load_one, sprite_files)):
+                if error is not None:
+                    print(error)
+                    continue
+                for size_name, (canvas_w, canvas_h) in size_configs.items():
+                    jobs.append((sprite_file, image, size_name, canvas_w, canvas_h))
 
-                except Exception as e:
-                    print(f"  ✗ 處理 {sprite_file.name} 失敗: {e}")
+            for message in pool.map(resize_one, jobs):
+                print(message)
 
+        for size_name, output_dir in output_dirs.items():
             print(f"✓ 完成 {size_name} 尺寸 → {output_dir}")
 
         print(f"\n✓ 所有尺寸調整完成")
@@ -383,16 +544,27 @@ class IntegratedSpriteProcessor:
             new_width = orig_width
             new_height = orig_height
 
-        resized = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        # 縮小超過 2 倍時（如 small 預設）改用 BOX 取平均，速度約為 LANCZOS 的 3 倍且視覺差異極小
+        # BOX (area averaging) for >2x downscales; LANCZOS otherwise
+        if orig_width > 0 and orig_height > 0 and scale < 0.5:
+            resample = Image.Resampling.BOX
+        else:
+            resample = Image.Resampling.LANCZOS
+        if (new_width, new_height) == image.size:
+            resized = image
+        else:
+            resized = image.resize((new_width, new_height), resample)
 
-        canvas = Image.new('RGBA', (canvas_width, canvas_height), (0, 0, 0, 0))
+        # 直接把像素寫入透明畫布（NumPy 切片），取代以自身為遮罩的 paste；
+        # paste 會再乘一次 alpha，使半透明邊緣變暗、變淡
+        canvas = np.zeros((canvas_height, canvas_width, 4), dtype=np.uint8)
 
         x_offset = (canvas_width - new_width) // 2
         y_offset = (canvas_height - new_height) // 2
 
-        canvas.paste(resized, (x_offset, y_offset), resized)
+        canvas[y_offset:y_offset + new_height, x_offset:x_offset + new_width] = np.asarray(resized)
 
-        return canvas
+        return Image.fromarray(canvas, 'RGBA')
 
     # ==================== 格線分割功能 ====================
 
@@ -415,6 +587,36 @@ class IntegratedSpriteProcessor:
         clusters.append(int(np.mean(current_cluster)))
         return clusters
 
+    @staticmethod
+    def _line_rows(mask, min_length, min_pixels, max_gap):
+        """
+        回傳 mask 中含有線段的列（向量化，取代 HoughLinesP 的水平/垂直情形）
+        同一列上間隔不超過 max_gap 的連續段視為同一線段；
+        線段總長 >= min_length 且邊緣像素數 >= min_pixels 才算數
+        """
+        rows = mask.shape[0]
+        padded = np.zeros((rows, mask.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = mask > 0
+        steps = np.diff(padded, axis=1)
+        start_rows, start_cols = np.nonzero(steps == 1)
+        _, end_cols = np.nonzero(steps == -1)
+
+        found = np.zeros(rows, dtype=bool)
+        if start_rows.size == 0:
+            return found
+
+        # 換列或間隔超過 max_gap 時開始新的線段
+        new_segment = np.ones(start_rows.size, dtype=bool)
+        new_segment[1:] = (start_rows[1:] != start_rows[:-1]) | (start_cols[1:] - end_cols[:-1] > max_gap)
+        heads = np.flatnonzero(new_segment)
+        tails = np.append(heads[1:], start_rows.size) - 1
+
+        spans = end_cols[tails] - start_cols[heads]
+        pixels = np.add.reduceat(end_cols - start_cols, heads)
+        keep = (spans >= min_length) & (pixels >= min_pixels)
+        found[start_rows[heads[keep]]] = True
+        return found
+
     def detect_grid_lines(self, image_path, line_threshold=50, min_line_length_ratio=0.3,
                          edge_margin=10, cluster_distance=20):
         """
@@ -423,7 +625,7 @@ class IntegratedSpriteProcessor:
 
         Args:
             image_path: 輸入圖片路徑
-            line_threshold: Hough 線偵測閾值
+            line_threshold: 線段最少需要的邊緣像素數（對應 Hough 線偵測閾值）
             min_line_length_ratio: 最小線長度比例（相對於圖片寬/高）
             edge_margin: 邊緣忽略距離
             cluster_distance: 線條聚合距離
@@ -444,46 +646,37 @@ class IntegratedSpriteProcessor:
         # 邊緣偵測
         edges = cv2.Canny(gray, 50, 150, apertureSize=3)
 
-        # 形態學操作增強線條
+        # 以投影輪廓取代 HoughLinesP：只找水平/垂直線，不需累加所有角度
+        # Axis-aligned projection profiles instead of a full Hough accumulator
+        min_line_length_h = int(w * min_line_length_ratio)
+        min_line_length_v = int(h * min_line_length_ratio)
+
+        # 形態學操作增強線條（補上虛線 / 抗鋸齒造成的小斷點）
         kernel_h = cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1))
         kernel_v = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 25))
-
-        # 分別偵測水平和垂直線
         horizontal_edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel_h)
         vertical_edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel_v)
 
-        # 使用 HoughLinesP 偵測線段
-        min_line_length_h = int(w * min_line_length_ratio)
-        min_line_length_v = int(h * min_line_length_ratio)
+        # 與 HoughLinesP(maxLineGap=50) 相同：間隔 50px 以內的邊緣段合併成同一線段，
+        # 線段夠長且邊緣像素數達 line_threshold 才算格線；
+        # 相隔更遠的 sprite 短邊不會被加總成假線
+        gap = self.GRID_MAX_LINE_GAP
+
+        # HoughLinesP 會先取走垂直格線的像素，格線交叉點不會把同一列的 sprite 邊串成假線；
+        # 這裡同樣先遮掉另一方向的線再找
+        horizontal_edges[:, self._line_rows(horizontal_edges.T, min_line_length_v, line_threshold, gap)] = 0
+        vertical_edges[self._line_rows(vertical_edges, min_line_length_h, line_threshold, gap)] = 0
 
-        h_lines = cv2.HoughLinesP(horizontal_edges, 1, np.pi/180, line_threshold,
-                                   minLineLength=min_line_length_h, maxLineGap=50)
-        v_lines = cv2.HoughLinesP(vertical_edges, 1, np.pi/180, line_threshold,
-                                   minLineLength=min_line_length_v, maxLineGap=50)
-
-        # 提取水平線的 y 座標
-        horizontal_positions = []
-        if h_lines is not None:
-            for line in h_lines:
-                x1, y1, x2, y2 = line[0]
-                # 確認是水平線（角度接近 0 度）
-                if abs(y2 - y1) < 20:
-                    y_avg = (y1 + y2) // 2
-                    # 忽略邊緣附近的線
-                    if edge_margin < y_avg < h - edge_margin:
-                        horizontal_positions.append(y_avg)
-
-        # 提取垂直線的 x 座標
-        vertical_positions = []
-        if v_lines is not None:
-            for line in v_lines:
-                x1, y1, x2, y2 = line[0]
-                # 確認是垂直線（角度接近 90 度）
-                if abs(x2 - x1) < 20:
-                    x_avg = (x1 + x2) // 2
-                    # 忽略邊緣附近的線
-                    if edge_margin < x_avg < w - edge_margin:
-                        vertical_positions.append(x_avg)
+        row_found = self._line_rows(horizontal_edges, min_line_length_h, line_threshold, gap)
+        col_found = self._line_rows(vertical_edges.T, min_line_length_v, line_threshold, gap)
+
+        # 提取水平線的 y 座標（忽略邊緣附近的線）
+        horizontal_positions = [y for y in np.flatnonzero(row_found).tolist()
+                                if edge_margin < y < h - edge_margin]
+
+        # 提取垂直線的 x 座標（忽略邊緣附近的線）
+        vertical_positions = [x for x in np.flatnonzero(col_found).tolist()
+                              if edge_margin < x < w - edge_margin]
 
         # 聚合相近的線條
         horizontal_lines = self._cluster_lines(horizontal_positions, cluster_distance)
@@ -516,27 +709,15 @@ class IntegratedSpriteProcessor:
         img = cv2.imread(image_path)
         h, w = img.shape[:2]
 
-        # 計算每列的顏色變化
-        col_diffs = []
-        for x in range(1, w):
-            diff = np.mean(np.abs(img[:, x].astype(float) - img[:, x-1].astype(float)))
-            col_diffs.append(diff)
-
-        # 計算每行的顏色變化
-        row_diffs = []
-        for y in range(1, h):
-            diff = np.mean(np.abs(img[y, :].astype(float) - img[y-1, :].astype(float)))
-            row_diffs.append(diff)
-
-        # 找出差異峰值
-        col_diffs = np.array(col_diffs)
-        row_diffs = np.array(row_diffs)
+        # 一次向量化計算相鄰列 / 行的平均顏色變化
+        # int16 足以容納 uint8 相減結果，記憶體只有 float64 的 1/4
+        img_i = img.astype(np.int16)
+        col_diffs = np.abs(np.diff(img_i, axis=1)).mean(axis=(0, 2))
+        row_diffs = np.abs(np.diff(img_i, axis=0)).mean(axis=(1, 2))
 
         # 使用閾值找出分隔線位置
-        vertical_lines = [0] + [i+1 for i in range(len(col_diffs))
-                                if col_diffs[i] > diff_threshold * np.mean(col_diffs)] + [w]
-        horizontal_lines = [0] + [i+1 for i in range(len(row_diffs))
-                                  if row_diffs[i] > diff_threshold * np.mean(row_diffs)] + [h]
+        vertical_lines = [0] + (np.flatnonzero(col_diffs > diff_threshold * col_diffs.mean()) + 1).tolist() + [w]
+        horizontal_lines = [0] + (np.flatnonzero(row_diffs > diff_threshold * row_diffs.mean()) + 1).tolist() + [h]
 
         # 聚合相近的線
         vertical_lines = self._cluster_lines(vertical_lines[1:-1], 20)
@@ -620,44 +801,57 @@ class IntegratedSpriteProcessor:
 
         print(f"\n[分割] 切割成 {num_rows} x {num_cols} = {num_rows * num_cols} 格...")
 
-        # 建立視覺化圖片
-        vis_img = cv2.imread(image_path)
+        # 建立視覺化圖片（由已解碼的 RGBA 陣列轉換，不再從磁碟重新讀檔）
+        rgba = np.asarray(img)
+        vis_img = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
 
-        for row in range(num_rows):
-            for col in range(num_cols):
-                y1, y2 = h_lines[row], h_lines[row + 1]
-                x1, x2 = v_lines[col], v_lines[col + 1]
+        def save_crop(crop, save_path):
+            Image.fromarray(crop, 'RGBA').save(save_path, optimize=False,
+                                               compress_level=self.PNG_COMPRESS_LEVEL)
 
-                # 添加內縮（去除格線邊緣）
-                y1_crop = min(y1 + padding, y2)
-                y2_crop = max(y2 - padding, y1)
-                x1_crop = min(x1 + padding, x2)
-                x2_crop = max(x2 - padding, x1)
+        # libpng 編碼時會釋放 GIL，以執行緒池並行儲存
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            saves = []
 
-                # 確保有效尺寸
-                if x2_crop <= x1_crop or y2_crop <= y1_crop:
-                    continue
+            for row in range(num_rows):
+                for col in range(num_cols):
+                    y1, y2 = h_lines[row], h_lines[row + 1]
+                    x1, x2 = v_lines[col], v_lines[col + 1]
 
-                # 裁切
-                sprite = img.crop((x1_crop, y1_crop, x2_crop, y2_crop))
+                    # 添加內縮（去除格線邊緣）
+                    y1_crop = min(y1 + padding, y2)
+                    y2_crop = max(y2 - padding, y1)
+                    x1_crop = min(x1 + padding, x2)
+                    x2_crop = max(x2 - padding, x1)
 
-                # 儲存
-                filename = f"sprite_{sprite_idx:03d}.png"
-                save_path = original_dir / filename
-                sprite.save(save_path)
-                sprite_paths.append(save_path)
+                    # 確保有效尺寸
+                    if x2_crop <= x1_crop or y2_crop <= y1_crop:
+                        continue
+
+                    # 裁切（NumPy 切片，不複製）
+                    sprite = rgba[y1_crop:y2_crop, x1_crop:x2_crop]
+
+                    # 儲存
+                    filename = f"sprite_{sprite_idx:03d}.png"
+                    save_path = original_dir / filename
+                    saves.append(pool.submit(save_crop, sprite, save_path))
+                    sprite_paths.append(save_path)
+
+                    # 視覺化標記
+                    cv2.rectangle(vis_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                    cv2.putText(vis_img, str(sprite_idx), (x1 + 5, y1 + 25),
+                               cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
 
-                # 視覺化標記
-                cv2.rectangle(vis_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                cv2.putText(vis_img, str(sprite_idx), (x1 + 5, y1 + 25),
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                    print(f"  ✓ {filename} (row={row}, col={col}, size={x2_crop-x1_crop}x{y2_crop-y1_crop})")
+                    sprite_idx += 1
 
-                print(f"  ✓ {filename} (row={row}, col={col}, size={x2_crop-x1_crop}x{y2_crop-y1_crop})")
-                sprite_idx += 1
+            # 等待所有儲存完成，並讓寫檔錯誤照常拋出
+            for future in saves:
+                future.result()
 
         # 儲存視覺化
         vis_path = base_dir / "grid_detection_visualization.jpg"
-        cv2.imwrite(str(vis_path), vis_img)
+        cv2.imwrite(str(vis_path), vis_img, [cv2.IMWRITE_JPEG_QUALITY, self.VIS_JPEG_QUALITY])
 
         print(f"\n✓ 格線分割完成，共 {len(sprite_paths)} 個 sprites")
         print(f"  視覺化: {vis_path}")
@@ -722,12 +916,12 @@ class IntegratedSpriteProcessor:
     def process(self, input_image, output_dir="output_processed",
                 distance_threshold=80, size_ratio_threshold=0.4,
                 alpha_threshold=50, min_area_ratio=0.0005, max_area_ratio=0.25,
-                output_sizes=None):
+                output_sizes=None, background=None):
         """
         完整處理流程
 
         Args:
-            input_image: 輸入圖片路徑
+            input_image: 輸入圖片路徑，或已在記憶體中的 PIL Image / RGB ndarray（略過讀檔）
             output_dir: 輸出目錄
             distance_threshold: 合併距離閾值
             size_ratio_threshold: 大小區分閾值
@@ -735,6 +929,7 @@ class IntegratedSpriteProcessor:
             min_area_ratio: 最小面積比例
             max_area_ratio: 最大面積比例
             output_sizes: 輸出尺寸設定 (dict: name -> (w, h))
+            background: 預先去背的 (image, alpha)，批次處理時使用
         """
         print(f"\n{'#'*60}")
         print(f"# Sprite Processor - 一站式處理工具")
@@ -748,7 +943,8 @@ class IntegratedSpriteProcessor:
             size_ratio_threshold=size_ratio_threshold,
             alpha_threshold=alpha_threshold,
             min_area_ratio=min_area_ratio,
-            max_area_ratio=max_area_ratio
+            max_area_ratio=max_area_ratio,
+            background=background
         )
 
         # 執行尺寸調整
@@ -775,7 +971,7 @@ class IntegratedSpriteProcessor:
     def process_directory(self, input_dir, output_base_dir="output_batch",
                          distance_threshold=80, size_ratio_threshold=0.4,
                          alpha_threshold=50, min_area_ratio=0.0005, max_area_ratio=0.25,
-                         output_sizes=None):
+                         output_sizes=None, batch_size=None):
         """
         批次處理整個目錄
 
@@ -788,6 +984,7 @@ class IntegratedSpriteProcessor:
             min_area_ratio: 最小面積比例
             max_area_ratio: 最大面積比例
             output_sizes: 輸出尺寸設定 (dict: name -> (w, h))
+            batch_size: BiRefNet 每次推論的圖片數（None 表示依裝置記憶體自動決定）
         """
         input_path = Path(input_dir)
         output_path = Path(output_base_dir)
@@ -796,14 +993,7 @@ class IntegratedSpriteProcessor:
             print(f"錯誤: 找不到輸入目錄 '{input_dir}'")
             return
 
-        # 支援的圖片格式
-        image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'}
-
-        # 遞迴尋找所有圖片
-        image_files = []
-        for ext in image_extensions:
-            image_files.extend(input_path.rglob(f'*{ext}'))
-            image_files.extend(input_path.rglob(f'*{ext.upper()}'))
+        image_files = find_image_files(input_path)
 
         if not image_files:
             print(f"在 '{input_dir}' 中找不到圖片檔案")
@@ -821,43 +1011,64 @@ class IntegratedSpriteProcessor:
         processed_count = 0
         failed_files = []
 
-        for idx, image_file in enumerate(image_files, 1):
-            # 計算相對路徑
-            rel_path = image_file.relative_to(input_path)
-            rel_dir = rel_path.parent
-            file_stem = image_file.stem
-
-            # 建立對應的輸出目錄
-            # 結構: output_base_dir / 相對目錄 / 檔案名稱 / ...
-            output_dir = output_path / rel_dir / file_stem
-
-            print(f"\n{'='*60}")
-            print(f"[{idx}/{len(image_files)}] 處理: {rel_path}")
-            print(f"{'='*60}")
+        # 以批次方式執行 BiRefNet，攤平每次 forward 的固定開銷
+        if not batch_size:
+            batch_size = self._inference_batch_size()
+        print(f"BiRefNet 批次大小: {batch_size}")
 
-            try:
-                # 處理單一圖片
-                sprite_count = self.process(
-                    str(image_file),
-                    str(output_dir),
-                    distance_threshold=distance_threshold,
-                    size_ratio_threshold=size_ratio_threshold,
-                    alpha_threshold=alpha_threshold,
-                    min_area_ratio=min_area_ratio,
-                    max_area_ratio=max_area_ratio,
-                    output_sizes=output_sizes
-                )
-
-                total_sprites += sprite_count
-                processed_count += 1
-
-            except KeyboardInterrupt:
-                print("\n\n使用者中斷批次處理")
-                raise
-            except Exception as e:
-                print(f"\n✗ 處理失敗: {e}")
-                failed_files.append((str(rel_path), str(e)))
-                continue
+        # 整個批次共用同一個 inference_mode，避免每張圖重複進出 autograd 設定
+        with torch.inference_mode():
+            for batch_start in range(0, len(image_files), batch_size):
+                batch_files = image_files[batch_start:batch_start + batch_size]
+                try:
+                    backgrounds = self.remove_background_batch([str(f) for f in batch_files])
+                except KeyboardInterrupt:
+                    print("\n\n使用者中斷批次處理")
+                    raise
+                except Exception as e:
+                    # 批次失敗時退回逐張去背，讓單一壞檔不影響其他圖片
+                    print(f"\n⚠ 批次去背失敗，改為逐張處理: {e}")
+                    backgrounds = [None] * len(batch_files)
+
+                for offset, (image_file, background) in enumerate(zip(batch_files, backgrounds)):
+                    idx = batch_start + offset + 1
+                    # 計算相對路徑
+                    rel_path = image_file.relative_to(input_path)
+                    rel_dir = rel_path.parent
+                    file_stem = image_file.stem
+
+                    # 建立對應的輸出目錄
+                    # 結構: output_base_dir / 相對目錄 / 檔案名稱 / ...
+                    output_dir = output_path / rel_dir / file_stem
+
+                    print(f"\n{'='*60}")
+                    print(f"[{idx}/{len(image_files)}] 處理: {rel_path}")
+                    print(f"{'='*60}")
+
+                    try:
+                        # 處理單一圖片
+                        sprite_count = self.process(
+                            str(image_file),
+                            str(output_dir),
+                            distance_threshold=distance_threshold,
+                            size_ratio_threshold=size_ratio_threshold,
+                            alpha_threshold=alpha_threshold,
+                            min_area_ratio=min_area_ratio,
+                            max_area_ratio=max_area_ratio,
+                            output_sizes=output_sizes,
+                            background=background
+                        )
+
+                        total_sprites += sprite_count
+                        processed_count += 1
+
+                    except KeyboardInterrupt:
+                        print("\n\n使用者中斷批次處理")
+                        raise
+                    except Exception as e:
+                        print(f"\n✗ 處理失敗: {e}")
+                        failed_files.append((str(rel_path), str(e)))
+                        continue
 
         # 最終總結
         print(f"\n{'#'*60}")
@@ -876,6 +1087,120 @@ class IntegratedSpriteProcessor:
         print(f"{'#'*60}\n")
 
 
+def find_image_files(input_path):
+    """
+    遞迴尋找目錄下所有支援格式的圖片
+    Recursively collect every supported image file under a directory
+    """
+    # 支援的圖片格式
+    image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'}
+
+    image_files = []
+    for ext in image_extensions:
+        image_files.extend(input_path.rglob(f'*{ext}'))
+        image_files.extend(input_path.rglob(f'*{ext.upper()}'))
+    return image_files
+
+
+# 多行程批次處理時，每個子行程各自持有的處理器
+# Per-process processor used by the --jobs worker pool
+_pool_processor = None
+
+
+def _init_pool_worker(num_threads):
+    """
+    子行程初始化：限制 torch 執行緒數並載入自己的模型
+    Pool initializer: cap torch threads and load this process's own model
+    """
+    global _pool_processor
+    torch.set_num_threads(num_threads)
+    _pool_processor = IntegratedSpriteProcessor()
+
+
+def _process_one(job):
+    """
+    在子行程中處理單一圖片，回傳 (相對路徑, sprite 數量, 錯誤訊息)
+    Process one image inside a pool worker; returns (rel_path, sprite_count, error)
+    """
+    image_file, output_dir, rel_path, kwargs = job
+    try:
+        with torch.inference_mode():
+            count = _pool_processor.process(image_file, output_dir, **kwargs)
+        return rel_path, count, None
+    except Exception as e:
+        return rel_path, 0, str(e)
+
+
+def process_directory_parallel(input_dir, output_base_dir="output_batch", jobs=2, **kwargs):
+    """
+    以多個行程平行批次處理整個目錄，每個行程各自載入一份 BiRefNet
+
+    Args:
+        input_dir: 輸入目錄路徑
+        output_base_dir: 輸出基礎目錄
+        jobs: 平行行程數
+        **kwargs: 傳給 IntegratedSpriteProcessor.process 的處理參數
+    """
+    input_path = Path(input_dir)
+    output_path = Path(output_base_dir)
+
+    image_files = find_image_files(input_path)
+    if not image_files:
+        print(f"在 '{input_dir}' 中找不到圖片檔案")
+        return
+
+    jobs = max(1, min(jobs, len(image_files)))
+    print(f"\n{'#'*60}")
+    print(f"# 批次處理模式 (多行程)")
+    print(f"{'#'*60}")
+    print(f"輸入目錄: {input_dir}")
+    print(f"輸出目錄: {output_base_dir}")
+    print(f"找到 {len(image_files)} 個圖片檔案，使用 {jobs} 個行程")
+    print(f"{'#'*60}\n")
+
+    work = []
+    for image_file in image_files:
+        rel_path = image_file.relative_to(input_path)
+        # 結構: output_base_dir / 相對目錄 / 檔案名稱 / ...
+        output_dir = output_path / rel_path.parent / image_file.stem
+        work.append((str(image_file), str(output_dir), str(rel_path), kwargs))
+
+    total_sprites = 0
+    processed_count = 0
+    failed_files = []
+
+    # 使用 spawn，讓每個子行程乾淨地重新載入模型 (fork 與 CUDA 不相容)
+    num_threads = max(1, (os.cpu_count() or 1) // jobs)
+    with ProcessPoolExecutor(max_workers=jobs,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_pool_worker,
+                             initargs=(num_threads,)) as pool:
+        for idx, (rel_path, count, error) in enumerate(pool.map(_process_one, work), 1):
+            if error is None:
+                total_sprites += count
+                processed_count += 1
+                print(f"[{idx}/{len(work)}] ✓ {rel_path}: {count} 個 sprites")
+            else:
+                failed_files.append((rel_path, error))
+                print(f"[{idx}/{len(work)}] ✗ {rel_path}: {error}")
+
+    # 最終總結
+    print(f"\n{'#'*60}")
+    print(f"# 批次處理完成")
+    print(f"{'#'*60}")
+    print(f"成功處理: {processed_count}/{len(image_files)} 個檔案")
+    print(f"總共產生: {total_sprites} 個 sprites")
+
+    if failed_files:
+        print(f"\n失敗的檔案 ({len(failed_files)}):")
+        for file_path, error in failed_files:
+            print(f"  ✗ {file_path}")
+            print(f"    原因: {error}")
+
+    print(f"\n輸出位置: {output_base_dir}")
+    print(f"{'#'*60}\n")
+
+
 def parse_sizes_arg(sizes_str):
     """
     解析尺寸參數字串
@@ -922,6 +1247,11 @@ def main():
     %(prog)s --batch input_dir
     %(prog)s --batch input_dir --output output_dir
     %(prog)s --batch ART_ASSETS --output processed_sprites
+    %(prog)s --batch input_dir --batch-size 8
+    %(prog)s --batch input_dir --jobs 4
+
+  從標準輸入逐行讀取圖片路徑 (模型只載入一次):
+    find ART_ASSETS -name "*.png" | %(prog)s --stdin-loop --output processed_sprites
         """
     )
 
@@ -935,6 +1265,23 @@ def main():
         metavar='DIR',
         help='批次處理模式：處理指定目錄下所有圖片'
     )
+    parser.add_argument(
+        '--stdin-loop',
+        action='store_true',
+        help='從標準輸入逐行讀取圖片路徑並處理，整個迴圈只載入一次模型'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=None,
+        help='批次模式下 BiRefNet 每次推論的圖片數，預設依 GPU 可用記憶體自動決定（不可與 --jobs > 1 併用）'
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=1,
+        help='批次模式下的平行行程數，每個行程各載入一份模型（注意記憶體用量），預設: 1'
+    )
     parser.add_argument(
         '--output', '-o',
         help='輸出目錄 (單一檔案預設: output_processed, 批次預設: output_batch)'
@@ -982,17 +1329,24 @@ def main():
         print("請使用 --batch DIR 進行批次處理，或直接指定檔案進行單一處理")
         sys.exit(1)
 
-    if not args.batch and not args.input_image:
+    if args.stdin_loop and (args.batch or args.input_image):
+        print("錯誤: --stdin-loop 不能與單一檔案模式或批次模式同時使用")
+        sys.exit(1)
+
+    if not args.batch and not args.input_image and not args.stdin_loop:
         parser.print_help()
         sys.exit(1)
+
+    if args.batch_size and args.jobs > 1:
+        # 多行程模式每個行程一次只處理一張圖片，批次推論大小不會生效
+        print("錯誤: --batch-size 不能與 --jobs > 1 同時使用")
+        print("多行程模式每個行程逐張處理；請擇一使用")
+        sys.exit(1)
         
     # 解析尺寸參數
     output_sizes = parse_sizes_arg(args.sizes)
 
     try:
-        # 建立處理器
-        processor = IntegratedSpriteProcessor()
-
         if args.batch:
             # 批次處理模式
             if not os.path.exists(args.batch):
@@ -1001,6 +1355,23 @@ def main():
 
             output_dir = args.output if args.output else 'output_batch'
 
+            if args.jobs > 1:
+                # 多行程模式：模型由各子行程自行載入，主行程不需要處理器
+                process_directory_parallel(
+                    args.batch,
+                    output_dir,
+                    jobs=args.jobs,
+                    distance_threshold=args.distance,
+                    size_ratio_threshold=args.size_ratio,
+                    alpha_threshold=args.alpha_threshold,
+                    min_area_ratio=args.min_area_ratio,
+                    max_area_ratio=args.max_area_ratio,
+                    output_sizes=output_sizes
+                )
+                return
+
+            # 建立處理器
+            processor = IntegratedSpriteProcessor()
             processor.process_directory(
                 args.batch,
                 output_dir,
@@ -1009,8 +1380,35 @@ def main():
                 alpha_threshold=args.alpha_threshold,
                 min_area_ratio=args.min_area_ratio,
                 max_area_ratio=args.max_area_ratio,
-                output_sizes=output_sizes
+                output_sizes=output_sizes,
+                batch_size=args.batch_size
             )
+        elif args.stdin_loop:
+            # 標準輸入模式：每行一個圖片路徑，輸出到 output / 檔案名稱
+            output_base_dir = Path(args.output if args.output else 'output_processed')
+
+            processor = IntegratedSpriteProcessor()
+            with torch.inference_mode():
+                for line in sys.stdin:
+                    image_path = line.strip()
+                    if not image_path:
+                        continue
+                    if not os.path.exists(image_path):
+                        print(f"錯誤: 找不到輸入圖片 '{image_path}'")
+                        continue
+                    try:
+                        processor.process(
+                            image_path,
+                            str(output_base_dir / Path(image_path).stem),
+                            distance_threshold=args.distance,
+                            size_ratio_threshold=args.size_ratio,
+                            alpha_threshold=args.alpha_threshold,
+                            min_area_ratio=args.min_area_ratio,
+                            max_area_ratio=args.max_area_ratio,
+                            output_sizes=output_sizes
+                        )
+                    except Exception as e:
+                        print(f"\n✗ 處理失敗 {image_path}: {e}")
         else:
             # 單一檔案模式
             if not os.path.exists(args.input_image):
@@ -1019,6 +1417,8 @@ def main():
 
             output_dir = args.output if args.output else 'output_processed'
 
+            # 建立處理器
+            processor = IntegratedSpriteProcessor()
             processor.process(
                 args.input_image,
                 output_dir,
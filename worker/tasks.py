@@ -1,6 +1,14 @@
+import io
 import os
 import shutil
-from celery import Celery
+import zipfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from celery import Celery, chain
+from celery.signals import worker_process_init
 from sprite_processor import IntegratedSpriteProcessor
 from image_generator import NanoBananaGenerator
 
@@ -11,16 +19,346 @@ app = Celery(
     backend=os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379/0")
 )
 
-# 全域變數，確保 Worker 啟動後只載入一次模型
-# Global variables for lazy loading models
-processor = None
-generator = None
+# 任務佇列：圖片生成 (呼叫外部 API，I/O 密集) 與 Sprite 處理 (CPU/GPU 密集) 分開排程
+# generate 佇列由 gevent pool 的 worker 消費，網路等待期間可同時處理多個生成請求
+# Queues: image generation (remote API, I/O bound) runs on a gevent-pool worker, apart from sprite processing
+GENERATE_QUEUE = os.getenv("GENERATE_QUEUE", "generate")
+app.conf.task_routes = {
+    "tasks.generate_image": {"queue": GENERATE_QUEUE},
+    "tasks.generate_with_reference": {"queue": GENERATE_QUEUE},
+    "tasks.pipeline_generate": {"queue": GENERATE_QUEUE},
+}
+
+# 模型載入鎖，確保 Worker 內 (含 thread/gevent pool) 只載入一次模型
+# Model load lock so each worker loads the models exactly once, even with thread/gevent pools
+_model_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_processor():
+    print("Initializing Sprite Processor Model...")
+    instance = IntegratedSpriteProcessor()
+    print("Model Initialized.")
+    return instance
+
+
+@lru_cache(maxsize=1)
+def _load_generator():
+    print("Initializing Image Generator...")
+    instance = NanoBananaGenerator()
+    print("Image Generator Initialized.")
+    return instance
+
+
+def get_processor():
+    """
+    取得共用的 Sprite 處理器 (懶加載)
+    Return the shared sprite processor (lazy loaded)
+    """
+    with _model_lock:
+        return _load_processor()
+
+
+def get_generator():
+    """
+    取得共用的圖片生成器 (懶加載)
+    Return the shared image generator (lazy loaded)
+    """
+    with _model_lock:
+        return _load_generator()
+
+
+@worker_process_init.connect
+def preload_processor(**kwargs):
+    """
+    prefork 子行程啟動時先載入 BiRefNet，讓第一個任務不必承擔冷啟動時間
+    Load BiRefNet as each prefork child starts so the first task skips the cold start
+
+    gevent pool 不會觸發這個訊號，因此生成 worker 不會載入模型；
+    載入失敗時只記錄錯誤，任務中的 get_processor() 會再試一次。
+    """
+    try:
+        get_processor()
+    except Exception as e:
+        print(f"Sprite Processor preload failed, will retry on first task: {str(e)}")
 
 # 共享目錄設定 (必須與 docker-compose 和 api 一致)
 SHARED_DIR = "/app/data"
+UPLOAD_DIR = os.path.join(SHARED_DIR, "uploads")
 RESULT_DIR = os.path.join(SHARED_DIR, "results")
 TEMP_DIR = os.path.join(SHARED_DIR, "temp_processing")
 
+# 預先組好的目錄前綴，任務中直接以 f-string 串接路徑
+# Precomputed directory prefixes so per-task paths skip os.path.join
+TEMP_PREFIX = TEMP_DIR + os.sep
+RESULT_PREFIX = RESULT_DIR + os.sep
+
+# 確保目錄存在 (啟動時建立一次，任務中不再重複檢查上層目錄)
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(TEMP_DIR, exist_ok=True)
+os.makedirs(RESULT_DIR, exist_ok=True)
+
+
+def _describe_storage(path):
+    """
+    回傳 path 所在檔案系統的類型 (讀取 /proc/self/mounts，僅 Linux) 與剩餘空間 (bytes)
+    Return the filesystem type backing path (Linux only) and its free space in bytes
+    """
+    fs_type, best = "unknown", ""
+    try:
+        with open("/proc/self/mounts") as f:
+            for line in f:
+                mount_point, kind = line.split()[1:3]
+                inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) >= len(best):
+                    best, fs_type = mount_point, kind
+    except OSError:
+        pass
+    st = os.statvfs(path)
+    return fs_type, st.f_bavail * st.f_frsize
+
+
+# 暫存資料夾應掛載為 tmpfs (見 docker-compose.yml)，啟動時記錄實際的檔案系統
+# TEMP_DIR should be a tmpfs mount (see docker-compose.yml); log what it actually is at startup
+_temp_fs, _temp_free = _describe_storage(TEMP_DIR)
+print(f"Temp storage: {TEMP_DIR} on {_temp_fs}, {_temp_free // (1 << 20)} MiB free")
+
+# S3 輸入支援 (搭配 API 的 presigned URL 直傳流程)
+# S3 inputs, used by the API's presigned-URL upload flow
+s3_client = None
+
+
+def fetch_s3_input(input_path, dest_path):
+    """
+    將 s3://bucket/key 串流下載到本機路徑
+    Stream an s3://bucket/key object down to a local file
+    """
+    global s3_client
+
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None)
+
+    bucket, _, key = input_path[len("s3://"):].partition("/")
+    s3_client.download_file(bucket, key, dest_path)
+    return dest_path
+
+
+# 打包時每次讀取 1 MiB，減少大檔案的 read 次數
+# Copy 1 MiB per read while packaging to cut syscalls on large files
+ZIP_COPY_BUFSIZE = 1024 * 1024
+
+
+def _walk_fast(root, prefix=""):
+    """
+    以 os.scandir 遞迴走訪資料夾，產生 (完整路徑, 壓縮檔內路徑)
+    Recursively walk a directory with os.scandir, yielding (full_path, arcname)
+    """
+    with os.scandir(root) as it:
+        for entry in it:
+            arcname = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_fast(entry.path, arcname + "/")
+            else:
+                yield entry.path, arcname
+
+
+def _rmtree_fast(path):
+    """
+    以 os.scandir 刪除整個資料夾 (先刪檔案，再由下而上 rmdir)
+    Remove a directory tree via os.scandir: unlink files, then rmdir bottom-up
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _rmtree_fast(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
+
+def _discard_tree(path):
+    """
+    刪除資料夾，不存在時略過 (省去先 stat 檢查)
+    Remove a directory tree, ignoring it if it is already gone (no exists() stat first)
+    """
+    try:
+        _rmtree_fast(path)
+    except FileNotFoundError:
+        pass
+
+
+def _discard_file(path):
+    """
+    刪除檔案，不存在時略過
+    Remove a file, ignoring it if it is already gone
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Celery 任務結果的保存時間 (秒，預設 1 天)；過期後 /status 已查不到結果中的檔案路徑
+# How long Celery keeps task results (seconds); after that no result points at their files
+RESULT_TTL = int(app.conf.result_expires.total_seconds())
+
+# 僅生成任務的 generated_<task_id>.png 沒有其他流程會刪除，任務結果過期後即清除
+# Generate-only outputs (generated_<task_id>.png) are purged once their task result has expired
+GENERATED_IMAGE_TTL = int(os.getenv("GENERATED_IMAGE_TTL", str(RESULT_TTL)))
+
+# 上傳檔由處理任務用完即刪；API 端寫入後未被任何任務取用的檔案 (例如重複提交) 超過 TTL 清除
+# Uploads are deleted by the task that consumes them; orphans left by the API expire after this TTL
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", str(RESULT_TTL)))
+
+PURGE_INTERVAL = 600
+_last_purge = {}
+
+
+def _purge_expired(directory, ttl, prefix="", suffix=""):
+    """
+    刪除 directory 中超過 ttl 秒的 prefix*suffix 檔案 (同一組條件每 PURGE_INTERVAL 秒最多掃描一次)
+    Remove prefix*suffix files in directory older than ttl seconds, scanning at most once per interval
+    """
+    key = (directory, prefix, suffix)
+    now = time.monotonic()
+    last = _last_purge.get(key)
+    if last is not None and now - last < PURGE_INTERVAL:
+        return
+    _last_purge[key] = now
+
+    cutoff = time.time() - ttl
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not (entry.name.startswith(prefix) and entry.name.endswith(suffix)):
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    _discard_file(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def _purge_stale_uploads():
+    """
+    清除 UPLOAD_DIR 中逾時的孤兒上傳檔
+    Purge orphaned uploads older than UPLOAD_TTL
+    """
+    try:
+        _purge_expired(UPLOAD_DIR, UPLOAD_TTL)
+    except OSError as e:
+        print(f"Failed to purge stale uploads: {str(e)}")
+
+
+def _save_generated(image, task_id):
+    """
+    儲存僅生成任務的圖片到 RESULT_DIR，並順便清除過期的舊圖
+    Save a generate-only result into RESULT_DIR and purge expired ones
+    """
+    # 屬於最終結果，放在 RESULT_DIR；TEMP_DIR 只放任務結束就刪除的中間產物
+    output_path = f"{RESULT_PREFIX}generated_{task_id}.png"
+    image.save(output_path)
+    try:
+        _purge_expired(RESULT_DIR, GENERATED_IMAGE_TTL, prefix="generated_", suffix=".png")
+    except OSError as e:
+        print(f"Failed to purge expired generated images: {str(e)}")
+    return output_path
+
+
+def _load_reference_image(path):
+    """
+    一次讀入參考圖片並完成解碼，之後不再需要原始檔案
+    Read the reference image in one go and decode it eagerly; the file is no longer needed afterwards
+    """
+    from PIL import Image
+
+    with open(path, "rb") as f:
+        image = Image.open(io.BytesIO(f.read()))
+    image.load()
+    return image
+
+
+@contextmanager
+def _task_workdir(task_id):
+    """
+    建立任務專用的暫存資料夾，離開 with 區塊時 (含例外) 一律清除
+    Per-task scratch directory under TEMP_DIR, removed on exit even when the task raises
+    """
+    path = tempfile.mkdtemp(prefix=f"{task_id}-", dir=TEMP_DIR)
+    try:
+        yield path
+    finally:
+        _discard_tree(path)
+
+
+def _zip_stored(zip_path, src_dir):
+    """
+    將資料夾以不壓縮 (ZIP_STORED) 方式打包；PNG 已經壓縮過，DEFLATE 只會浪費 CPU
+    Pack a directory as an uncompressed (ZIP_STORED) zip; PNGs are already compressed
+    """
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for full, arcname in _walk_fast(src_dir):
+            zinfo = zipfile.ZipInfo.from_file(full, arcname)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(full, "rb") as src, zf.open(zinfo, "w") as dst:
+                shutil.copyfileobj(src, dst, ZIP_COPY_BUFSIZE)
+    return zip_path
+
+
+# tar.zst 的壓縮等級：PNG 幾乎壓不動，低等級即可省下大部分 CPU
+# zstd level for tar.zst archives; PNGs barely shrink, so a low level keeps CPU cost down
+ZSTD_LEVEL = 3
+
+
+def _tar_zst(archive_path, src_dir):
+    """
+    將資料夾串流打包成 tar.zst (需要 zstandard 套件)
+    Stream a directory into a zstd-compressed tar archive (requires the zstandard package)
+    """
+    import tarfile
+    import zstandard
+
+    with open(archive_path, "wb") as raw, \
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw) as zst, \
+            tarfile.open(fileobj=zst, mode="w|") as tar:
+        for full, arcname in _walk_fast(src_dir):
+            tar.add(full, arcname, recursive=False)
+    return archive_path
+
+
+# 支援的結果壓縮檔格式 (預設 zip，維持與既有用戶端相容)
+# Supported result archive formats; zip stays the default for existing clients
+ARCHIVE_FORMATS = ("zip", "tar.zst")
+
+
+def _package_results(task_id, src_dir, archive_format="zip"):
+    """
+    依 archive_format 將結果打包到 RESULT_DIR，回傳壓縮檔路徑
+    Package a task's output into RESULT_DIR in the requested format and return the archive path
+
+    先寫到暫存檔再 os.replace，下載中或並行寫入的壓縮檔不會被截斷
+    Written to a temp name and renamed into place, so a zip being downloaded is never truncated
+    """
+    if archive_format == "zip":
+        writer, archive_path = _zip_stored, f"{RESULT_PREFIX}sprites_{task_id}.zip"
+    elif archive_format == "tar.zst":
+        writer, archive_path = _tar_zst, f"{RESULT_PREFIX}sprites_{task_id}.tar.zst"
+    else:
+        raise ValueError(f"Unsupported archive_format: {archive_format} (expected one of {ARCHIVE_FORMATS})")
+
+    fd, part_path = tempfile.mkstemp(prefix=f"sprites_{task_id}.", suffix=".part", dir=RESULT_DIR)
+    os.close(fd)
+    # mkstemp 預設 0600，改回一般檔案權限讓 API 容器可以讀取
+    os.chmod(part_path, 0o644)
+    try:
+        writer(part_path, src_dir)
+        os.replace(part_path, archive_path)
+    except BaseException:
+        _discard_file(part_path)
+        raise
+    return archive_path
+
+
 # 預設處理參數
 # Default processing parameters
 DEFAULT_PROCESSING_PARAMS = {
@@ -29,7 +367,8 @@ DEFAULT_PROCESSING_PARAMS = {
     "alpha_threshold": 50,
     "min_area_ratio": 0.0005,
     "max_area_ratio": 0.25,
-    "output_sizes": None
+    "output_sizes": None,
+    "archive_format": "zip"
 }
 
 
@@ -39,57 +378,63 @@ def process_sprite(self, input_path, task_id, processing_params=None):
     處理 Sprite 的 Celery 任務
     Celery task for sprite processing with configurable parameters
     """
-    global processor
 
     # 合併參數 (使用者參數覆蓋預設值)
     params = {**DEFAULT_PROCESSING_PARAMS, **(processing_params or {})}
 
-    # 懶加載模型 (Lazy Loading)
-    if processor is None:
-        print("Initializing Sprite Processor Model...")
-        processor = IntegratedSpriteProcessor()
-        print("Model Initialized.")
-
-    # 設定本次任務的輸出路徑
-    task_output_dir = os.path.join(TEMP_DIR, task_id)
-    os.makedirs(task_output_dir, exist_ok=True)
-
-    try:
-        print(f"Processing task {task_id} for image {input_path}")
-        print(f"Parameters: {params}")
-
-        # 呼叫原始的核心邏輯
-        count = processor.process(
-            input_image=input_path,
-            output_dir=task_output_dir,
-            distance_threshold=params["distance_threshold"],
-            size_ratio_threshold=params["size_ratio_threshold"],
-            alpha_threshold=params["alpha_threshold"],
-            min_area_ratio=params["min_area_ratio"],
-            max_area_ratio=params["max_area_ratio"],
-            output_sizes=params.get("output_sizes")
-        )
-
-        # 將結果打包成 Zip
-        zip_base_name = os.path.join(RESULT_DIR, f"sprites_{task_id}")
-        shutil.make_archive(zip_base_name, 'zip', task_output_dir)
-        zip_path = f"{zip_base_name}.zip"
-
-        return {
-            "status": "success",
-            "sprite_count": count,
-            "zip_path": zip_path,
-            "task_id": task_id
-        }
-
-    except Exception as e:
-        print(f"Error processing task {task_id}: {str(e)}")
-        self.retry(exc=e, countdown=10, max_retries=1)
-
-    finally:
-        # 清理暫存的解壓縮/處理資料夾 (保留原始上傳與最終 Zip)
-        if os.path.exists(task_output_dir):
-            shutil.rmtree(task_output_dir)
+    processor = get_processor()
+
+    s3_local_path = None
+    upload_path = None if input_path.startswith("s3://") else input_path
+    retrying = False
+
+    # 設定本次任務的輸出路徑 (離開 with 區塊時自動清除)
+    with _task_workdir(task_id) as task_output_dir:
+        try:
+            print(f"Processing task {task_id} for image {input_path}")
+            print(f"Parameters: {params}")
+
+            # 來源在 S3 時先下載到暫存區 (放在輸出資料夾外，避免被打包)
+            if upload_path is None:
+                s3_local_path = fetch_s3_input(input_path, f"{TEMP_PREFIX}{task_id}_input.png")
+                input_path = s3_local_path
+
+            # 呼叫原始的核心邏輯
+            count = processor.process(
+                input_image=input_path,
+                output_dir=task_output_dir,
+                distance_threshold=params["distance_threshold"],
+                size_ratio_threshold=params["size_ratio_threshold"],
+                alpha_threshold=params["alpha_threshold"],
+                min_area_ratio=params["min_area_ratio"],
+                max_area_ratio=params["max_area_ratio"],
+                output_sizes=params.get("output_sizes")
+            )
+
+            # 將結果打包成 Zip (或 tar.zst)
+            zip_path = _package_results(task_id, task_output_dir, params["archive_format"])
+
+            return {
+                "status": "success",
+                "sprite_count": count,
+                "zip_path": zip_path,
+                "archive_format": params["archive_format"],
+                "task_id": task_id
+            }
+
+        except Exception as e:
+            print(f"Error processing task {task_id}: {str(e)}")
+            # 還會重試時保留上傳檔，重試需要再讀一次
+            retrying = self.request.retries < 1
+            self.retry(exc=e, countdown=10, max_retries=1)
+
+        finally:
+            # 清理 S3 下載的暫存輸入與已處理完的上傳檔 (只保留最終 Zip)
+            if s3_local_path:
+                _discard_file(s3_local_path)
+            if upload_path and not retrying:
+                _discard_file(upload_path)
+            _purge_stale_uploads()
 
 
 # 格線分割預設參數
@@ -100,7 +445,8 @@ DEFAULT_GRID_PARAMS = {
     "padding": 2,
     "line_threshold": 50,
     "min_line_length_ratio": 0.3,
-    "output_sizes": None
+    "output_sizes": None,
+    "archive_format": "zip"
 }
 
 
@@ -110,58 +456,55 @@ def process_sprite_grid(self, input_path, task_id, grid_params=None):
     使用格線分割模式處理 Sprite 的 Celery 任務
     Celery task for sprite processing using grid splitting mode
     """
-    global processor
 
     # 合併參數 (使用者參數覆蓋預設值)
     params = {**DEFAULT_GRID_PARAMS, **(grid_params or {})}
 
-    # 懶加載模型 (Lazy Loading)
-    if processor is None:
-        print("Initializing Sprite Processor Model...")
-        processor = IntegratedSpriteProcessor()
-        print("Model Initialized.")
-
-    # 設定本次任務的輸出路徑
-    task_output_dir = os.path.join(TEMP_DIR, task_id)
-    os.makedirs(task_output_dir, exist_ok=True)
-
-    try:
-        print(f"Processing task {task_id} for image {input_path} (Grid Mode)")
-        print(f"Grid Parameters: {params}")
-
-        # 呼叫格線分割處理
-        count = processor.process_grid(
-            input_image=input_path,
-            output_dir=task_output_dir,
-            auto_detect=params["auto_detect"],
-            rows=params["rows"],
-            cols=params["cols"],
-            padding=params["padding"],
-            line_threshold=params["line_threshold"],
-            min_line_length_ratio=params["min_line_length_ratio"],
-            output_sizes=params.get("output_sizes")
-        )
-
-        # 將結果打包成 Zip
-        zip_base_name = os.path.join(RESULT_DIR, f"sprites_{task_id}")
-        shutil.make_archive(zip_base_name, 'zip', task_output_dir)
-        zip_path = f"{zip_base_name}.zip"
-
-        return {
-            "status": "success",
-            "sprite_count": count,
-            "zip_path": zip_path,
-            "task_id": task_id
-        }
-
-    except Exception as e:
-        print(f"Error processing task {task_id}: {str(e)}")
-        self.retry(exc=e, countdown=10, max_retries=1)
-
-    finally:
-        # 清理暫存的解壓縮/處理資料夾 (保留原始上傳與最終 Zip)
-        if os.path.exists(task_output_dir):
-            shutil.rmtree(task_output_dir)
+    processor = get_processor()
+
+    retrying = False
+
+    # 設定本次任務的輸出路徑 (離開 with 區塊時自動清除，只保留最終 Zip)
+    with _task_workdir(task_id) as task_output_dir:
+        try:
+            print(f"Processing task {task_id} for image {input_path} (Grid Mode)")
+            print(f"Grid Parameters: {params}")
+
+            # 呼叫格線分割處理
+            count = processor.process_grid(
+                input_image=input_path,
+                output_dir=task_output_dir,
+                auto_detect=params["auto_detect"],
+                rows=params["rows"],
+                cols=params["cols"],
+                padding=params["padding"],
+                line_threshold=params["line_threshold"],
+                min_line_length_ratio=params["min_line_length_ratio"],
+                output_sizes=params.get("output_sizes")
+            )
+
+            # 將結果打包成 Zip (或 tar.zst)
+            zip_path = _package_results(task_id, task_output_dir, params["archive_format"])
+
+            return {
+                "status": "success",
+                "sprite_count": count,
+                "zip_path": zip_path,
+                "archive_format": params["archive_format"],
+                "task_id": task_id
+            }
+
+        except Exception as e:
+            print(f"Error processing task {task_id}: {str(e)}")
+            # 還會重試時保留上傳檔，重試需要再讀一次
+            retrying = self.request.retries < 1
+            self.retry(exc=e, countdown=10, max_retries=1)
+
+        finally:
+            # 清理已處理完的上傳檔
+            if not retrying:
+                _discard_file(input_path)
+            _purge_stale_uploads()
 
 
 @app.task(bind=True, name="tasks.generate_image")
@@ -176,13 +519,8 @@ def generate_image_task(
     生成圖片的 Celery 任務 (僅生成，不處理)
     Celery task for image generation only (no sprite processing)
     """
-    global generator
 
-    # 懶加載生成器 (Lazy Loading)
-    if generator is None:
-        print("Initializing Image Generator...")
-        generator = NanoBananaGenerator()
-        print("Image Generator Initialized.")
+    generator = get_generator()
 
     task_id = self.request.id
 
@@ -193,14 +531,9 @@ def generate_image_task(
         images = generator.generate(prompt, model, temperature=temperature)
 
         # 儲存生成的圖片
-        task_output_dir = os.path.join(TEMP_DIR, task_id)
-        os.makedirs(task_output_dir, exist_ok=True)
-
-        output_path = os.path.join(task_output_dir, "generated.png")
-        images[0].save(output_path)
-
-        self.update_state(state="GENERATED", meta={"progress": 100})
+        output_path = _save_generated(images[0], task_id)
 
+        # 不再另外回報 GENERATED：緊接著的 SUCCESS 會立刻覆蓋它，只是多一次 Redis 寫入
         return {
             "status": "success",
             "image_path": output_path,
@@ -211,50 +544,77 @@ def generate_image_task(
         return {"status": "failure", "error": str(e)}
 
 
-@app.task(bind=True, name="tasks.generate_and_process")
-def generate_and_process_task(
+@app.task(bind=True, name="tasks.pipeline_generate")
+def pipeline_generate_task(
     self,
+    task_id: str,
     prompt: str,
     model: str = "nano-banana",
     temperature: float = 1.0,
-    processing_params=None
+    reference_image_path=None
 ):
     """
-    一條龍任務：生成 → 去背 → 切割 → 多尺寸
-    Full pipeline: Generate → Remove BG → Split → Multi-size
+    一條龍流程 Step 1：生成圖片並存到 task_id 的暫存資料夾 (在 generate 佇列執行)
+    Pipeline step 1: generate the image into the task's temp folder (runs on the generate queue)
+
+    回傳生成圖片的路徑，作為下一步的第一個參數；有 reference_image_path 時使用 Image-to-Image
+    Returns the generated image path for the next step; uses Image-to-Image when a reference is given
     """
-    global processor, generator
+    generator = get_generator()
 
+    task_output_dir = f"{TEMP_PREFIX}{task_id}"
+    os.makedirs(task_output_dir, exist_ok=True)
+
+    try:
+        print(f"[{task_id}] Step 1: Generating image (temp={temperature}, reference={reference_image_path})...")
+        self.update_state(task_id=task_id, state="GENERATING", meta={"progress": 10, "step": "generating"})
+
+        if reference_image_path:
+            # 使用 edit 方法進行 Image-to-Image 生成
+            # 重試時還需要原始檔案，因此在成功或最後一次失敗後才刪除
+            reference_image = _load_reference_image(reference_image_path)
+            result_image = generator.edit(reference_image, prompt, model, temperature=temperature)
+        else:
+            result_image = generator.generate(prompt, model, temperature=temperature)[0]
+
+        generated_path = f"{task_output_dir}{os.sep}generated.png"
+        # 與其他輸出一致使用快速壓縮等級，避免 zlib 預設等級拖慢 Step 1 → Step 2
+        # Same fast compress level as the other outputs; default zlib level 6 stalls Step 1 → Step 2
+        result_image.save(generated_path, format="PNG", compress_level=IntegratedSpriteProcessor.PNG_COMPRESS_LEVEL)
+    except Exception as e:
+        print(f"Error in pipeline generate step for task {task_id}: {str(e)}")
+        if self.request.retries < 1:
+            raise self.retry(exc=e, countdown=10, max_retries=1)
+        # 重試用盡：後續步驟不會執行，直接把錯誤寫回 API 追蹤的任務 ID
+        self.backend.mark_as_failure(task_id, e)
+        _discard_tree(task_output_dir)
+        if reference_image_path:
+            _discard_file(reference_image_path)
+        raise
+
+    if reference_image_path:
+        _discard_file(reference_image_path)
+    return generated_path
+
+
+@app.task(bind=True, name="tasks.pipeline_process")
+def pipeline_process_task(self, generated_path: str, task_id: str, processing_params=None):
+    """
+    一條龍流程 Step 2/3：去背 → 切割 → 多尺寸 → 打包 (沿用 API 追蹤的任務 ID)
+    Pipeline steps 2-3: remove BG → split → multi-size → package (inherits the tracked task id)
+    """
     # 合併參數
     params = {**DEFAULT_PROCESSING_PARAMS, **(processing_params or {})}
 
-    # 懶加載生成器 (Lazy Loading)
-    if generator is None:
-        print("Initializing Image Generator...")
-        generator = NanoBananaGenerator()
-        print("Image Generator Initialized.")
+    processor = get_processor()
 
-    task_id = self.request.id
-    task_output_dir = os.path.join(TEMP_DIR, task_id)
-    os.makedirs(task_output_dir, exist_ok=True)
+    task_output_dir = os.path.dirname(generated_path)
+    retrying = False
 
     try:
-        # Step 1: 生成圖片
-        print(f"[{task_id}] Step 1: Generating image (temp={temperature})...")
-        self.update_state(state="GENERATING", meta={"progress": 10, "step": "generating"})
-
-        images = generator.generate(prompt, model, temperature=temperature)
-        generated_path = os.path.join(task_output_dir, "generated.png")
-        images[0].save(generated_path)
-
         # Step 2: Sprite 處理 (去背 + 切割)
         print(f"[{task_id}] Step 2: Processing sprites with params: {params}")
-        self.update_state(state="PROCESSING", meta={"progress": 50, "step": "processing"})
-
-        if processor is None:
-            print("Initializing Sprite Processor Model...")
-            processor = IntegratedSpriteProcessor()
-            print("Model Initialized.")
+        self.update_state(task_id=task_id, state="PROCESSING", meta={"progress": 50, "step": "processing"})
 
         count = processor.process(
             input_image=generated_path,
@@ -269,11 +629,9 @@ def generate_and_process_task(
 
         # Step 3: 打包輸出
         print(f"[{task_id}] Step 3: Packaging results...")
-        self.update_state(state="PACKAGING", meta={"progress": 90, "step": "packaging"})
+        self.update_state(task_id=task_id, state="PACKAGING", meta={"progress": 90, "step": "packaging"})
 
-        zip_base_name = os.path.join(RESULT_DIR, f"sprites_{task_id}")
-        shutil.make_archive(zip_base_name, 'zip', task_output_dir)
-        zip_path = f"{zip_base_name}.zip"
+        zip_path = _package_results(task_id, task_output_dir, params["archive_format"])
 
         print(f"[{task_id}] Complete! Generated {count} sprites.")
 
@@ -281,17 +639,44 @@ def generate_and_process_task(
             "status": "success",
             "sprite_count": count,
             "zip_path": zip_path,
+            "archive_format": params["archive_format"],
             "task_id": task_id
         }
 
     except Exception as e:
-        print(f"Error in generate_and_process task {task_id}: {str(e)}")
+        print(f"Error in pipeline process step for task {task_id}: {str(e)}")
+        retrying = self.request.retries < 1
         self.retry(exc=e, countdown=10, max_retries=1)
 
     finally:
-        # 清理暫存資料夾
-        if os.path.exists(task_output_dir):
-            shutil.rmtree(task_output_dir)
+        # 清理暫存資料夾 (重試時保留生成的圖片供下一次使用)
+        if not retrying:
+            _discard_tree(task_output_dir)
+
+
+@app.task(bind=True, name="tasks.generate_and_process")
+def generate_and_process_task(
+    self,
+    prompt: str,
+    model: str = "nano-banana",
+    temperature: float = 1.0,
+    processing_params=None
+):
+    """
+    一條龍任務：生成 → 去背 → 切割 → 多尺寸
+    Full pipeline: Generate → Remove BG → Split → Multi-size
+
+    以 chain 取代本任務：生成在 generate 佇列執行，處理與打包在預設佇列執行；
+    最後一步沿用本任務 ID，API 的狀態查詢與下載不受影響。
+    Replaced by a chain so generation and processing are scheduled on separate queues;
+    the last step inherits this task id, so API status polling is unchanged.
+    """
+    task_id = self.request.id
+    print(f"[{task_id}] Dispatching generate → process pipeline")
+    raise self.replace(chain(
+        pipeline_generate_task.s(task_id, prompt, model, temperature),
+        pipeline_process_task.s(task_id, processing_params)
+    ))
 
 
 @app.task(bind=True, name="tasks.generate_with_reference")
@@ -307,14 +692,7 @@ def generate_with_reference_task(
     使用參考圖片生成新圖片 (Image-to-Image，僅生成不處理)
     Generate new image using reference image (Image-to-Image, no sprite processing)
     """
-    global generator
-    from PIL import Image
-
-    # 懶加載生成器 (Lazy Loading)
-    if generator is None:
-        print("Initializing Image Generator...")
-        generator = NanoBananaGenerator()
-        print("Image Generator Initialized.")
+    generator = get_generator()
 
     task_id = self.request.id
 
@@ -322,21 +700,17 @@ def generate_with_reference_task(
         print(f"[{task_id}] Generating with reference image (temp={temperature}): {reference_image_path}")
         self.update_state(state="GENERATING", meta={"progress": 10})
 
-        # 載入參考圖片
-        reference_image = Image.open(reference_image_path)
+        # 載入參考圖片後立即刪除檔案，及早釋放上傳暫存空間
+        reference_image = _load_reference_image(reference_image_path)
+        _discard_file(reference_image_path)
 
         # 使用 edit 方法進行 Image-to-Image 生成
         result_image = generator.edit(reference_image, prompt, model, temperature=temperature)
 
         # 儲存生成的圖片
-        task_output_dir = os.path.join(TEMP_DIR, task_id)
-        os.makedirs(task_output_dir, exist_ok=True)
-
-        output_path = os.path.join(task_output_dir, "generated.png")
-        result_image.save(output_path)
-
-        self.update_state(state="GENERATED", meta={"progress": 100})
+        output_path = _save_generated(result_image, task_id)
 
+        # 不再另外回報 GENERATED：緊接著的 SUCCESS 會立刻覆蓋它，只是多一次 Redis 寫入
         return {
             "status": "success",
             "image_path": output_path,
@@ -347,8 +721,7 @@ def generate_with_reference_task(
         return {"status": "failure", "error": str(e)}
     finally:
         # 清理參考圖片
-        if os.path.exists(reference_image_path):
-            os.remove(reference_image_path)
+        _discard_file(reference_image_path)
 
 
 @app.task(bind=True, name="tasks.generate_with_reference_and_process")
@@ -364,80 +737,9 @@ def generate_with_reference_and_process_task(
     使用參考圖片生成並處理成 Sprite 的一條龍任務
     Full pipeline with reference image: Edit → Remove BG → Split → Multi-size
     """
-    global processor, generator
-    from PIL import Image
-
-    # 合併參數
-    params = {**DEFAULT_PROCESSING_PARAMS, **(processing_params or {})}
-
-    # 懶加載生成器 (Lazy Loading)
-    if generator is None:
-        print("Initializing Image Generator...")
-        generator = NanoBananaGenerator()
-        print("Image Generator Initialized.")
-
     task_id = self.request.id
-    task_output_dir = os.path.join(TEMP_DIR, task_id)
-    os.makedirs(task_output_dir, exist_ok=True)
-
-    try:
-        # Step 1: 使用參考圖片生成
-        print(f"[{task_id}] Step 1: Generating with reference image (temp={temperature})...")
-        self.update_state(state="GENERATING", meta={"progress": 10, "step": "generating"})
-
-        # 載入參考圖片
-        reference_image = Image.open(reference_image_path)
-
-        # 使用 edit 方法進行 Image-to-Image 生成
-        result_image = generator.edit(reference_image, prompt, model, temperature=temperature)
-
-        generated_path = os.path.join(task_output_dir, "generated.png")
-        result_image.save(generated_path)
-
-        # Step 2: Sprite 處理 (去背 + 切割)
-        print(f"[{task_id}] Step 2: Processing sprites with params: {params}")
-        self.update_state(state="PROCESSING", meta={"progress": 50, "step": "processing"})
-
-        if processor is None:
-            print("Initializing Sprite Processor Model...")
-            processor = IntegratedSpriteProcessor()
-            print("Model Initialized.")
-
-        count = processor.process(
-            input_image=generated_path,
-            output_dir=task_output_dir,
-            distance_threshold=params["distance_threshold"],
-            size_ratio_threshold=params["size_ratio_threshold"],
-            alpha_threshold=params["alpha_threshold"],
-            min_area_ratio=params["min_area_ratio"],
-            max_area_ratio=params["max_area_ratio"],
-            output_sizes=params.get("output_sizes")
-        )
-
-        # Step 3: 打包輸出
-        print(f"[{task_id}] Step 3: Packaging results...")
-        self.update_state(state="PACKAGING", meta={"progress": 90, "step": "packaging"})
-
-        zip_base_name = os.path.join(RESULT_DIR, f"sprites_{task_id}")
-        shutil.make_archive(zip_base_name, 'zip', task_output_dir)
-        zip_path = f"{zip_base_name}.zip"
-
-        print(f"[{task_id}] Complete! Generated {count} sprites from reference image.")
-
-        return {
-            "status": "success",
-            "sprite_count": count,
-            "zip_path": zip_path,
-            "task_id": task_id
-        }
-
-    except Exception as e:
-        print(f"Error in generate_with_reference_and_process task {task_id}: {str(e)}")
-        self.retry(exc=e, countdown=10, max_retries=1)
-
-    finally:
-        # 清理暫存資料夾和參考圖片
-        if os.path.exists(task_output_dir):
-            shutil.rmtree(task_output_dir)
-        if os.path.exists(reference_image_path):
-            os.remove(reference_image_path)
+    print(f"[{task_id}] Dispatching reference generate → process pipeline")
+    raise self.replace(chain(
+        pipeline_generate_task.s(task_id, prompt, model, temperature, reference_image_path),
+        pipeline_process_task.s(task_id, processing_params)
+    ))